@@ -1,5 +1,7 @@
 import sys
 import os
+import json
+import time
 import requests
 from datetime import datetime
 from PyQt6.QtWidgets import (
@@ -7,14 +9,50 @@ from PyQt6.QtWidgets import (
     QLabel, QFileDialog, QHBoxLayout, QListWidgetItem, QDialog, QScrollArea
 )
 from PyQt6.QtGui import QPixmap, QColor
-from PyQt6.QtCore import Qt, QUrl, QTimer
+from PyQt6.QtCore import Qt, QUrl, QTimer, QThread, pyqtSignal
 from PyQt6.QtMultimedia import QMediaPlayer, QAudioOutput
 from PyQt6.QtMultimediaWidgets import QVideoWidget
 
 API_BASE = "http://5.129.253.254/api"
+MESSAGES_PAGE = 200  # сколько последних сообщений показывать при открытии диалога
+FALLBACK_REFRESH = 60000  # мс: страховочный опрос на случай, если поток событий оборвался незаметно
+DIALOGS_POLL = 5000  # мс: опрос списка диалогов, если сервер не отдаёт поток событий
+MESSAGES_POLL = 3000  # мс: опрос открытого чата в том же случае
+EVENTS_READ_TIMEOUT = 60  # секунд тишины в потоке событий (сервер пингует каждые 15), после которых переподключаемся
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+class EventStream(QThread):
+    """
+    Читает поток событий сервера (/api/events/, SSE) и передаёт их в GUI; при обрыве переподключается.
+    Если сервер работает без ASGI (501), сообщает unavailable и завершается.
+    """
+    event = pyqtSignal(dict)
+    unavailable = pyqtSignal()
+
+    def run(self):
+        last_id = None
+        while True:
+            try:
+                # с Last-Event-ID сервер дошлёт то, что пришло, пока связи не было
+                headers = {"Last-Event-ID": str(last_id)} if last_id else {}
+                with requests.get(f"{API_BASE}/events/", headers=headers, stream=True,
+                                  timeout=(5, EVENTS_READ_TIMEOUT)) as r:
+                    if r.status_code == 501:
+                        # сервер запущен без ASGI и потока не будет — переходим на опрос
+                        self.unavailable.emit()
+                        return
+                    r.raise_for_status()
+                    for line in r.iter_lines(decode_unicode=True):
+                        if line and line.startswith("data:"):
+                            event = json.loads(line[5:])
+                            last_id = event["id"]
+                            self.event.emit(event)
+            except Exception as e:
+                print("Поток событий оборвался:", e)
+            time.sleep(3)
+
+
 class ChatGUI(QWidget):
     def __init__(self):
         super().__init__()
@@ -24,6 +62,8 @@ class ChatGUI(QWidget):
         self.dialogs = []
         self.messages = []
         self.current_dialog_id = None
+        self.changes_cursor = None  # курсор /messages/changes/ открытого диалога
+        self.older_url = None  # ссылка rel="prev" на сообщения старше показанных
         self.media_to_send = []
 
         # --- layout ---
@@ -37,6 +77,11 @@ class ChatGUI(QWidget):
         # правая панель
         right_layout = QVBoxLayout()
 
+        self.older_btn = QPushButton("⬆ Загрузить старые сообщения")
+        self.older_btn.clicked.connect(self.load_older_messages)
+        self.older_btn.setEnabled(False)
+        right_layout.addWidget(self.older_btn)
+
         self.message_list = QListWidget()
         right_layout.addWidget(self.message_list, 8)
 
@@ -62,14 +107,31 @@ class ChatGUI(QWidget):
 
         main_layout.addLayout(right_layout, 3)
 
-        # таймеры
+        # обновления приходят событиями сервера, таймеры — только страховка
         self.dialog_timer = QTimer()
         self.dialog_timer.timeout.connect(self.load_dialogs)
-        self.dialog_timer.start(5000)
+        self.dialog_timer.start(FALLBACK_REFRESH)
 
         self.message_timer = QTimer()
         self.message_timer.timeout.connect(self.refresh_current_dialog)
-        self.message_timer.start(3000)
+        self.message_timer.start(FALLBACK_REFRESH)
+
+        # пачку событий (например, импорт истории) превращаем в одну перезагрузку списка диалогов
+        self.dialogs_reload = QTimer()
+        self.dialogs_reload.setSingleShot(True)
+        self.dialogs_reload.setInterval(500)
+        self.dialogs_reload.timeout.connect(self.load_dialogs)
+
+        # так же для открытого чата: пачка событий — один запрос изменений, а не запрос на каждое событие
+        self.messages_reload = QTimer()
+        self.messages_reload.setSingleShot(True)
+        self.messages_reload.setInterval(300)
+        self.messages_reload.timeout.connect(self.refresh_current_dialog)
+
+        self.events = EventStream()
+        self.events.event.connect(self.on_server_event)
+        self.events.unavailable.connect(self.poll_instead_of_events)
+        self.events.start()
 
         # загрузка диалогов
         self.load_dialogs()
@@ -82,6 +144,7 @@ class ChatGUI(QWidget):
     # === загрузка диалогов ===
     def load_dialogs(self):
         try:
+            # API отдаёт все диалоги, сначала с самыми свежими сообщениями; последнее сообщение — вместе с диалогом
             r = requests.get(f"{API_BASE}/dialogs/")
             r.raise_for_status()
             self.dialogs = r.json()
@@ -91,16 +154,10 @@ class ChatGUI(QWidget):
                 last_msg_text = ""
                 last_msg_time = ""
 
-                try:
-                    r2 = requests.get(f"{API_BASE}/messages/?dialog={dlg['id']}&limit=1")
-                    if r2.status_code == 200:
-                        msgs = r2.json()
-                        if msgs:
-                            msg = msgs[-1]  # последнее сообщение
-                            last_msg_text = f"{msg['sender_name']}: {msg['text'][:30]}"
-                            last_msg_time = msg["date"][11:16]
-                except Exception as e:
-                    print("Ошибка получения последнего сообщения:", e)
+                msg = dlg.get("last_message")
+                if msg:
+                    last_msg_text = f"{msg['sender_name']}: {msg['text'][:30]}"
+                    last_msg_time = msg["date"][11:16]
 
                 item_text = f"{dlg['chat_title']} ({dlg['account_phone']})\n{last_msg_text} {last_msg_time}"
                 item = QListWidgetItem(item_text)
@@ -112,6 +169,27 @@ class ChatGUI(QWidget):
         except Exception as e:
             print("Ошибка загрузки диалогов:", e)
 
+    # === события сервера ===
+    def on_server_event(self, event):
+        # таймер не перезапускаем, если он уже взведён: при непрерывном потоке событий
+        # обновление всё равно произойдёт не позже чем через интервал таймера
+        if event["type"] == "stream.reset":
+            # пропущенные события уже удалены из журнала сервера — перечитываем всё
+            self.changes_cursor = None
+            self.schedule(self.messages_reload)
+        elif event["dialog"] == self.current_dialog_id:
+            self.schedule(self.messages_reload)
+        self.schedule(self.dialogs_reload)
+
+    def poll_instead_of_events(self):
+        self.dialog_timer.start(DIALOGS_POLL)
+        self.message_timer.start(MESSAGES_POLL)
+
+    @staticmethod
+    def schedule(timer):
+        if not timer.isActive():
+            timer.start()
+
     # === открытие диалога ===
     def open_dialog(self, item):
         index = self.dialog_list.currentRow()
@@ -124,34 +202,79 @@ class ChatGUI(QWidget):
         if not self.current_dialog_id:
             return
         try:
-            r = requests.get(f"{API_BASE}/messages/?dialog={self.current_dialog_id}")
+            # курсор изменений берём до загрузки, чтобы не пропустить то, что придёт между запросами
+            r = requests.get(f"{API_BASE}/messages/changes/", params={"dialog": self.current_dialog_id})
+            r.raise_for_status()
+            self.changes_cursor = r.json()["cursor"]
+            # последние MESSAGES_PAGE сообщений
+            r = requests.get(f"{API_BASE}/messages/", params={"dialog": self.current_dialog_id, "limit": MESSAGES_PAGE})
             r.raise_for_status()
             self.messages = r.json()
-
-            self.message_list.clear()
-            for msg in self.messages:
-                self.add_message_to_list(msg)
+            self.set_older_url(r)
+            self.show_messages()
 
             if scroll_to_bottom:
                 self.message_list.scrollToBottom()
         except Exception as e:
             print("Ошибка загрузки сообщений:", e)
 
+    # === подгрузка истории старше показанной ===
+    def load_older_messages(self):
+        if not self.current_dialog_id or not self.older_url:
+            return
+        try:
+            r = requests.get(self.older_url)
+            r.raise_for_status()
+            older = r.json()
+            self.set_older_url(r)
+            if older:
+                self.messages = older + self.messages
+                self.show_messages()
+                self.message_list.scrollToTop()
+        except Exception as e:
+            print("Ошибка загрузки старых сообщений:", e)
+
+    def set_older_url(self, r):
+        # пустая страница ссылок не несёт — значит, старше ничего нет
+        self.older_url = r.links.get("prev", {}).get("url")
+        self.older_btn.setEnabled(self.older_url is not None)
+
+    def show_messages(self):
+        self.message_list.clear()
+        for msg in self.messages:
+            self.add_message_to_list(msg)
+
     # === обновление активного чата ===
     def refresh_current_dialog(self):
         if not self.current_dialog_id:
             return
         try:
-            r = requests.get(f"{API_BASE}/messages/?dialog={self.current_dialog_id}")
+            if self.changes_cursor is None:
+                self.load_messages(scroll_to_bottom=True)
+                return
+            # только изменения после курсора: у молчащего чата — пустой ответ
+            r = requests.get(f"{API_BASE}/messages/changes/",
+                             params={"dialog": self.current_dialog_id, "since": self.changes_cursor})
+            if r.status_code == 410:
+                # курсор старше журнала изменений на сервере — перезагружаем чат целиком
+                self.load_messages(scroll_to_bottom=True)
+                return
             r.raise_for_status()
-            new_messages = r.json()
+            delta = r.json()
 
-            if len(new_messages) > len(self.messages):
-                for msg in new_messages[len(self.messages):]:
+            if delta["updated"] or delta["deleted"] or delta["has_more"]:
+                # изменились уже показанные сообщения — проще перерисовать чат
+                self.load_messages(scroll_to_bottom=True)
+                return
+            self.changes_cursor = delta["cursor"]
+            # курсор берётся до загрузки страницы, так что созданное между запросами уже может быть в списке
+            shown = {msg["id"] for msg in self.messages}
+            created = [msg for msg in delta["created"] if msg["id"] not in shown]
+            if created:
+                for msg in created:
                     self.add_message_to_list(msg)
                 self.message_list.scrollToBottom()
-
-            self.messages = new_messages
+                self.messages.extend(created)
         except Exception as e:
             print("Ошибка автообновления диалога:", e)
 
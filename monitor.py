@@ -1,174 +1,931 @@
+import argparse
 import asyncio
+import bisect
+import contextlib
+import functools
+import heapq
+import itertools
+import json
+import multiprocessing
 import os
-import tempfile
+import re
+import queue
+import signal
+import time
+import zlib
+from collections import defaultdict
 from datetime import datetime
+from urllib.parse import unquote, urlsplit
 import requests
+from requests.adapters import HTTPAdapter
 from pyrogram import Client
 from pyrogram.errors import FloodWait
+from pyrogram.handlers import MessageHandler, EditedMessageHandler
 from pyrogram.types import InputMediaDocument, InputMediaVideo, InputMediaPhoto
+from session_creator import start_client
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SESSIONS_DIR = os.path.join(BASE_DIR, "sessions")
-MEDIA_DIR = os.path.join(BASE_DIR, "tgserver", "media")
-os.makedirs(MEDIA_DIR, exist_ok=True)
+STATE_DIR = os.path.join(BASE_DIR, "state")  # локальное состояние монитора между перезапусками
+os.makedirs(STATE_DIR, exist_ok=True)
+MEDIA_DIR = os.path.join(BASE_DIR, "tgserver", "media")  # MEDIA_ROOT Django
+MEDIA_UPLOAD_TO = "media"  # как upload_to у Media.file
+MEDIA_URL = "/media/"  # MEDIA_URL Django
+MEDIA_HOST = "http://5.129.253.254"  # откуда качать медиа, если файла нет в локальном MEDIA_DIR
+os.makedirs(os.path.join(MEDIA_DIR, MEDIA_UPLOAD_TO), exist_ok=True)
 
 API_FILE = os.path.join(BASE_DIR, "api.txt")
 ACCOUNTS_FILE = os.path.join(BASE_DIR, "accounts.txt")
 API_BASE = "http://127.0.0.1/api"
 
+SCAN_INTERVAL = 3  # секунд между циклами
+RECONCILE_INTERVAL = 60  # в push-режиме: секунд между полными сверочными сканами
+ALBUM_WAIT = 1  # в push-режиме: сколько ждём остальные части альбома
+INGEST_BATCH = 50  # сообщений в одном запросе к /messages/bulk/
+MEDIA_DOWNLOADS = 4  # одновременных скачиваний медиа из Telegram со всех аккаунтов
+STARTUP_CONCURRENCY = 10  # клиентов, подключаемых одновременно при старте
+STARTUP_TIMEOUT = 60  # секунд на подключение одного аккаунта, потом он считается нерабочим
+SESSIONS_WATCH = 10  # секунд между проверками папки sessions на новые и удалённые сессии
+SESSION_SETTLE = 10  # файл сессии моложе этого ещё может дописываться session_creator'ом
+ACCOUNT_RETRY = 300  # секунд до повторной попытки запустить аккаунт, который не стартовал
+SEND_RETRY_BASE = 10  # секунд до первого повтора неудачной отправки, дальше удваивается
+SEND_RETRY_MAX = 3600  # потолок паузы между повторами отправки
+SEND_MAX_ATTEMPTS = 8  # после стольких неудач сообщение уходит в dead-letter и больше не отправляется
+OUTBOX_FILES_DIR = os.path.join(STATE_DIR, "outbox_files")  # скачанные для отправки файлы до успешной отправки
+DIALOG_CONCURRENCY = 8  # диалогов одного аккаунта, синхронизируемых одновременно
+ROSTER_PAGE = 100  # диалогов в быстром обновлении списка (одна страница get_dialogs)
+ROSTER_REFRESH = 600  # секунд между полными перечитываниями списка диалогов
+POLL_MIN = SCAN_INTERVAL  # секунд: как часто читаем историю активного диалога
+POLL_MAX = 600  # секунд: реже этого не проверяем даже давно молчащий диалог
+POLL_AGE_FACTOR = 0.1  # интервал проверки — такая доля времени, которое диалог молчит
+MAX_SEEN_RANGES = 1000  # отрезков уже сохранённых id на диалог (выше отметки синхронизации)
+BACKFILL_PAGE = 100  # сообщений за один шаг фоновой загрузки истории (первая страница нового диалога — тоже)
+BACKFILL_INTERVAL = 1  # секунд между проходами догрузки по диалогам, пока есть что догружать
+BACKFILL_IDLE = 30  # секунд между проверками, когда догружать нечего
+
+# --- Бюджеты запросов к Telegram на один аккаунт ---
+REQUEST_LIMITS = {  # вид запроса -> (запросов в секунду, запас на всплеск)
+    "send": (1, 3),
+    "dialogs": (0.5, 2),
+    "download": (3, 5),
+    "history": (2, 5),
+    "backfill": (1, 2),
+}
+REQUEST_PRIORITY = {"send": 0, "dialogs": 1, "download": 2, "history": 3, "backfill": 4}  # меньше — раньше
+ACCOUNT_LIMIT = (5, 10)  # общий бюджет аккаунта: (запросов в секунду, запас)
+FLOOD_RETRY_MAX = 60  # FloodWait дольше этого не пережидаем в вызове, а откладываем работу
+SCHEDULER_TICK = 0.05  # как часто ожидающий запрос проверяет свою очередь
+
+# --- Режим супервизора (--workers N) ---
+STATUS_INTERVAL = 30  # секунд между отчётами воркеров супервизору
+WORKER_TIMEOUT = 300  # воркер без отчётов дольше этого считается зависшим и перезапускается
+WORKER_STOP_TIMEOUT = 30  # секунд на штатную остановку воркера по SIGTERM, потом SIGKILL
+RESTART_DELAY = 5  # секунд перед перезапуском упавшего воркера
+STATUS_FILE = os.path.join(STATE_DIR, "status.json")
+METRICS_HOST = "127.0.0.1"  # метрики Prometheus отдаются только локально
+METRICS_PORT = 9108  # порт /metrics (в режиме --workers у воркера N — METRICS_PORT + N), 0 — выключено
+METRICS_LOG_INTERVAL = 60  # секунд между сводками метрик в лог (одна JSON-строка)
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # границы гистограмм, секунд
+API_MAX_CONNECTIONS = 10  # одновременных запросов к Django со всех аккаунтов
+API_TIMEOUT = (5, 60)  # (connect, read) секунд на запрос к Django
+DIALOG_PAGE = 500  # диалогов на странице при загрузке списка из Django (максимум API)
+DOWNLOAD_CHUNK = 1024 * 1024  # байт за одну запись при скачивании файла с сервера
+
 # --- Чтение API ID / HASH ---
 with open(API_FILE, encoding="utf-8") as f:
     API_ID = int(f.readline().strip())
     API_HASH = f.readline().strip()
 
 # --- Номера аккаунтов (в accounts.txt номера начинаются с '+') ---
-ACCOUNTS = []
-for session_file in os.listdir('sessions'):
-    ACCOUNTS.append(session_file.split('.')[0])
+def list_accounts(settle=0):
+    """
+    Аккаунты по файлам в sessions/, без служебных файлов sqlite.
+    settle — пропускать сессии, изменённые меньше стольких секунд назад (ещё могут дописываться).
+    """
+    accounts = {}
+    now = time.time()
+    for session_file in os.listdir(SESSIONS_DIR):
+        if session_file.endswith("-journal"):
+            continue
+        if settle:
+            try:
+                if now - os.path.getmtime(os.path.join(SESSIONS_DIR, session_file)) < settle:
+                    continue
+            except OSError:
+                continue
+        accounts[session_file.split('.')[0]] = True
+    return sorted(accounts)
+
+def shard_of(phone, workers):
+    """Номер воркера, которому принадлежит аккаунт: не меняется при добавлении других сессий."""
+    return zlib.crc32(phone.encode()) % workers
+
+def chat_title_of(chat):
+    """Читабельное название чата."""
+    return chat.title or ((chat.first_name or "") + (" " + chat.last_name if chat.last_name else "")) or str(chat.id)
+
+class Metrics:
+    """
+    Счётчики, гистограммы и текущие значения монитора с метками (этап, аккаунт, вид запроса...).
+    render() — текстовый формат Prometheus для /metrics, summary() — краткая сводка для лога.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counters = defaultdict(float)  # (имя, метки) -> значение
+        self.gauges = {}  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счётчики по корзинам, сумма, количество]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        h = self.histograms.setdefault(self._key(name, labels), [[0] * len(self.buckets), 0.0, 0])
+        i = bisect.bisect_left(self.buckets, seconds)
+        if i < len(self.buckets):
+            h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Замеряет время блока with (в том числе с await внутри) в гистограмму name."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def forget(self, **labels):
+        """Убирает все значения с такими метками (например, остановленного аккаунта)."""
+        items = set((k, str(v)) for k, v in labels.items())
+        for store in (self.counters, self.gauges, self.histograms):
+            for key in [key for key in store if items <= set(key[1])]:
+                del store[key]
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escape = lambda v: v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({name for name, _ in store}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in sorted(store.items()):
+                    if n == name:
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), (counts, total, count) in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, c in zip(self.buckets, counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', f'{le:g}')])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total:g}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Сводка для лога: счётчики и текущие значения как есть, у гистограмм — количество, сумма и среднее."""
+        fmt = lambda name, labels: name + self._labels(labels)
+        return {
+            "counters": {fmt(*key): value for key, value in sorted(self.counters.items())},
+            "gauges": {fmt(*key): value for key, value in sorted(self.gauges.items())},
+            "timings": {fmt(*key): {"count": count, "sum": round(total, 3), "avg": round(total / count, 4)}
+                        for key, (_, total, count) in sorted(self.histograms.items()) if count},
+        }
+
+    async def serve(self, port, host=METRICS_HOST):
+        """Отдаёт render() по HTTP на host:port (любой путь) для Prometheus."""
+        async def handle(reader, writer):
+            try:
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                body = self.render().encode()
+                writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                             + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+                await writer.drain()
+            except Exception as e:
+                print("metrics request error:", e)
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+metrics = Metrics()
+
+def api_endpoint(url):
+    """
+    Метка запроса к Django: путь без API_BASE, query string и id (/messages/:id/) —
+    чтобы число серий метрик не росло с каждым новым сообщением.
+    """
+    path, base = urlsplit(url).path, urlsplit(API_BASE).path
+    return re.sub(r"/\d+(?=/|$)", "/:id", path[len(base):] if path.startswith(base) else path)
+
+class ApiClient:
+    """
+    Общий для всех аккаунтов клиент Django API.
+    Держит пул keep-alive соединений и ограничивает число одновременных запросов;
+    блокирующие вызовы requests выполняются в потоках, чтобы не останавливать event loop.
+    """
+    def __init__(self, max_connections=API_MAX_CONNECTIONS, timeout=API_TIMEOUT):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_connections)
+
+    async def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with metrics.timer("monitor_api_wait_seconds"):
+            await self.semaphore.acquire()
+        try:
+            with metrics.timer("monitor_api_seconds", method=method, endpoint=api_endpoint(url)):
+                return await asyncio.to_thread(self.session.request, method, url, **kwargs)
+        finally:
+            self.semaphore.release()
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def patch(self, url, **kwargs):
+        return await self.request("PATCH", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    async def download(self, url, path):
+        """
+        Скачивает файл в path (через .part, чтобы не оставить недокачанный),
+        возвращает path (None, если не удалось).
+        """
+        def _download():
+            with self.session.get(url, stream=True, timeout=self.timeout) as r:
+                if r.status_code != 200:
+                    return None
+                with open(path + ".part", "wb") as f:
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                        f.write(chunk)
+                os.replace(path + ".part", path)
+                return path
+
+        async with self.semaphore:
+            result = await asyncio.to_thread(_download)
+        if result is not None:
+            metrics.inc("monitor_api_download_bytes_total", os.path.getsize(result))
+        return result
+
+    def close(self):
+        self.session.close()
+
+api = ApiClient()
 
 # --- Вспомогательные API-функции (Django REST) ---
-def find_dialog(account_phone, chat_id):
-    """Ищем существующий диалог в Django по номеру аккаунта и chat_id."""
+class DialogIndex:
+    """
+    Кэш диалогов Django: (account_phone, chat_id) -> диалог (json).
+    Загружается целиком один раз при старте, дальше пополняется по мере создания/поиска диалогов.
+    """
+    def __init__(self):
+        self.dialogs = {}
+
+    async def load(self):
+        try:
+            # список отдаётся страницами, следующая — по ссылке rel="next" из заголовка Link
+            url, params = f"{API_BASE}/dialogs/", {"limit": DIALOG_PAGE}
+            while url:
+                r = await api.get(url, params=params)
+                r.raise_for_status()
+                page = r.json()
+                for dlg in page:
+                    self.add(dlg)
+                url, params = (r.links.get("next", {}).get("url") if page else None), None
+            print(f"Загружено диалогов: {len(self.dialogs)}")
+        except Exception as e:
+            print("dialog index load error:", e)
+
+    def add(self, dlg):
+        self.dialogs[(dlg["account_phone"], int(dlg["chat_id"]))] = dlg
+
+    def get(self, account_phone, chat_id):
+        return self.dialogs.get((account_phone, int(chat_id)))
+
+    def forget(self, dialog_ids):
+        """Убирает диалоги, которых больше нет в Django: при следующем обращении они найдутся/создадутся заново."""
+        for key, dlg in list(self.dialogs.items()):
+            if dlg["id"] in dialog_ids:
+                del self.dialogs[key]
+
+dialog_index = DialogIndex()
+
+async def find_dialog(account_phone, chat_id):
+    """Ищем существующий диалог по номеру аккаунта и chat_id: сначала в кэше, потом в Django."""
+    dlg = dialog_index.get(account_phone, chat_id)
+    if dlg:
+        return dlg
     try:
-        r = requests.get(f"{API_BASE}/dialogs/")
+        r = await api.get(f"{API_BASE}/dialogs/", params={"account_phone": account_phone, "chat_id": chat_id})
         r.raise_for_status()
         for dlg in r.json():
-            try:
-                if dlg.get("account_phone") == account_phone and int(dlg.get("chat_id")) == int(chat_id):
-                    return dlg
-            except Exception:
-                continue
+            dialog_index.add(dlg)
+            return dlg
     except Exception as e:
         print("find_dialog error:", e)
     return None
 
-def create_dialog(account_phone, chat_id, chat_title):
-    """Создаёт диалог через API, если его ещё нет."""
-    existing = find_dialog(account_phone, chat_id)
+async def create_dialog(account_phone, chat_id, chat_title):
+    """Создаёт диалог через API, если его ещё нет. Возвращает диалог (json)."""
+    existing = await find_dialog(account_phone, chat_id)
     if existing:
-        return existing["id"]
+        return existing
     try:
         payload = {
             "account_phone": account_phone,
             "chat_id": str(chat_id),
             "chat_title": chat_title
         }
-        r = requests.post(f"{API_BASE}/dialogs/", json=payload)
+        r = await api.post(f"{API_BASE}/dialogs/", json=payload)
         if r.status_code in (200, 201):
             print(f"[{account_phone}] Создан диалог {chat_title} ({chat_id}) -> id {r.json().get('id')}")
-            return r.json().get("id")
+            dialog_index.add(r.json())
+            return r.json()
         else:
             print(f"[{account_phone}] Ошибка create_dialog: {r.status_code} {r.text}")
     except Exception as e:
         print("create_dialog error:", e)
     return None
 
-def get_undelivered_messages_for_account(account_phone):
+async def save_sync_state(dialog_id, last_telegram_id):
+    """Сохраняет в Django telegram_id последнего забранного сообщения диалога."""
+    try:
+        r = await api.patch(f"{API_BASE}/dialogs/{dialog_id}/sync/", json={"last_telegram_id": last_telegram_id})
+        r.raise_for_status()
+        return True
+    except Exception as e:
+        print("save_sync_state error:", e)
+        return False
+
+async def get_undelivered_messages_for_account(account_phone):
     """
-    Берём все сообщения delivered=false и фильтруем те, которые привязаны к этому аккаунту.
-    Возвращаем список сообщений (json).
+    Недоставленные (delivered=false) сообщения этого аккаунта одним запросом.
+    Каждое сообщение уже содержит chat_id своего диалога и список медиа.
+    None — если Django недоступен (в отличие от пустого outbox).
     """
     try:
-        r = requests.get(f"{API_BASE}/messages/?delivered=false")
+        r = await api.get(f"{API_BASE}/outbox/", params={"account_phone": account_phone})
         r.raise_for_status()
-        msgs = []
-        for msg in r.json():
-            try:
-                dlg = requests.get(f"{API_BASE}/dialogs/{msg['dialog']}/").json()
-                for d in dlg:
-                    if d['id'] == msg['dialog']:
-                        dlg = d
-                        if dlg["account_phone"] == account_phone:
-                            msgs.append(msg)
-            except Exception:
-                continue
-        return msgs
+        return r.json()
     except Exception as e:
         print("get_undelivered_messages_for_account error:", e)
-        return []
+        return None
 
-def create_message(dialog_id, sender_name, text, date_iso, delivered=True, telegram_id=None,media=None):
+async def create_messages(messages):
     """
-    Создаём сообщение через API.
-    Если передан telegram_id — проверяем уникальность (dialog + telegram_id).
-    media_file хранится как относительный путь от BASE_DIR.
+    Пакетно создаём сообщения через API (/messages/bulk/), одной транзакцией.
+    messages — список словарей с полями сообщения и списком "media"
+    [{"file", "media_type", "file_unique_id"}] — файлы уже лежат в MEDIA_ROOT, не загружаем их.
+    Сообщения, уже сохранённые с тем же (dialog, telegram_id), сервер молча пропускает.
+    Возвращает ответ сервера ({"created": [...], "skipped": n}) или None при ошибке;
+    если диалога пачки уже нет в Django — {"created": [], "skipped": 0, "missing_dialogs": [...]}.
     """
     try:
-        if telegram_id is not None:
-            q = f"{API_BASE}/messages/?dialog={dialog_id}&telegram_id={telegram_id}"
-            rchk = requests.get(q)
-            rchk.raise_for_status()
-            if rchk.json():
-                if text == 'пидор':
-                    print(q)
-                    print(rchk.json())
-                # Уже есть сообщение с таким telegram_id в этом диалоге
-                return False
-    except Exception:
-        # если проверка упала — продолжим попытку создания (без стопа)
-        pass
-
-    payload = {
-        "dialog": dialog_id,
-        "sender_name": sender_name,
-        "text": text or "",
-        "date": date_iso,
-        "delivered": delivered,
-        "telegram_id": telegram_id
-    }
-    files_to_send = []
-    for m in media:
-        path = m.get("file_path")
-        if not path or not os.path.exists(path):
-            continue
-        f = open(path, "rb")
-        files_to_send.append(("files", (os.path.basename(path), f)))
-    try:
-        try:
-            url = f'{API_BASE}/messages_media/'
-            r = requests.post(url, data=payload, files=files_to_send)
-            if r.status_code not in (200, 201):
-                print("Ошибка создания сообщения:", r.text)
-            else:
-                print("Сообщение с медиа добавлено в Django")
-        finally:
-            for _, (_, f) in files_to_send:
-                f.close()
-
+        r = await api.post(f"{API_BASE}/messages/bulk/", json={"messages": messages})
         if r.status_code in (200, 201):
             return r.json()
         else:
-            print("create_message failed:", r.status_code, r.text)
-            return False
+            print("create_messages failed:", r.status_code, r.text)
+            missing = r.json().get("missing_dialogs") if r.status_code == 400 else None
+            if missing:
+                # диалог удалён в Django — забываем его, чтобы не слать в него каждую пачку
+                dialog_index.forget(missing)
+                return {"created": [], "skipped": 0, "missing_dialogs": missing}
+            return None
     except Exception as e:
-        print("create_message error:", e)
-        return False
+        print("create_messages error:", e)
+        return None
+
+async def update_message_text(dialog_id, telegram_id, text):
+    """Обновляет текст уже сохранённого сообщения (после редактирования в Telegram)."""
+    try:
+        r = await api.get(f"{API_BASE}/messages/?dialog={dialog_id}&telegram_id={telegram_id}")
+        r.raise_for_status()
+        for msg in r.json():
+            await api.patch(f"{API_BASE}/messages/{msg['id']}/", json={"text": text})
+            print(f"Updated text: {msg['id']}")
+    except Exception as e:
+        print("update_message_text error:", e)
 
-def mark_delivered(message_id,new_id):
+async def mark_delivered(message_id,new_id):
     try:
-        requests.delete(f"{API_BASE}/messages/{message_id}/", json={"delivered": True,'created_id':new_id})
+        await api.delete(f"{API_BASE}/messages/{message_id}/", json={"delivered": True,'created_id':new_id})
         print(f"Marked delivered: {message_id}")
     except Exception as e:
         print("mark_delivered error:", e)
 
+class MediaStore:
+    """
+    Скачивание медиа из Telegram прямо в MEDIA_ROOT Django.
+    Файл хранится под своим file_unique_id, поэтому пересланный/повторный файл
+    скачивается и хранится один раз; одновременных скачиваний не больше MEDIA_DOWNLOADS.
+    """
+    def __init__(self, root=MEDIA_DIR, workers=MEDIA_DOWNLOADS):
+        self.root = root
+        self.semaphore = asyncio.Semaphore(workers)
+        self.pending = {}  # file_unique_id -> задача скачивания (один файл качаем один раз)
+
+    async def fetch(self, download, msg):
+        """
+        download — корутина скачивания (msg, file_name=...) аккаунта, которому принадлежит сообщение.
+        Возвращает {"file", "media_type", "file_unique_id"} для медиа сообщения
+        (file — путь относительно MEDIA_ROOT) или None, если медиа нет.
+        """
+        if msg.photo:
+            media, suffix, media_type = msg.photo, ".jpg", "photo"
+        elif msg.video:
+            media, suffix, media_type = msg.video, ".mp4", "video"
+        elif msg.voice:
+            media, suffix, media_type = msg.voice, ".ogg", "voice"
+        elif msg.video_note:
+            media, suffix, media_type = msg.video_note, ".mp4", "video_note"
+        elif msg.document:
+            media, media_type = msg.document, "document"
+            suffix = os.path.splitext(msg.document.file_name or "")[1] or ".dat"
+        else:
+            return None  # нет медиа
+
+        key = media.file_unique_id
+        name = f"{MEDIA_UPLOAD_TO}/{key}{suffix}"
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            task = self.pending.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._download(download, msg, path))
+                self.pending[key] = task
+                task.add_done_callback(lambda _: self.pending.pop(key, None))
+            await task
+        return {"file": name, "media_type": media_type, "file_unique_id": key}
+
+    async def _download(self, download, msg, path):
+        async with self.semaphore:
+            part = path + ".part"
+            await download(msg, file_name=part)
+            os.replace(part, path)
+
+media_store = MediaStore()
+
+class JsonState:
+    """
+    Локальное состояние в JSON-файле: self.data — словарь с целыми ключами (id диалога или сообщения).
+    save() пишет через .tmp и os.replace, чтобы после падения не остался недописанный файл,
+    и только если с прошлого раза что-то менялось (dirty).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                # на месте: подклассы держат self.data под своими именами
+                self.data.update({int(k): v for k, v in json.load(f).items()})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"cannot load {self.path}: {e}")
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+class SeenTracker(JsonState):
+    """
+    Какие telegram_id уже сохранены в Django — по диалогам, отрезками [от, до].
+    Всё, что не выше отметки синхронизации диалога, и так считается сохранённым,
+    поэтому храним только id выше неё (например, пришедшие апдейтами) и обрезаем их по мере
+    движения отметки. Сохраняется в файл и читается при старте.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.ranges = self.data  # dialog_id -> отсортированный список [от, до]
+
+    def seen(self, dialog_id, telegram_id):
+        ranges = self.ranges.get(dialog_id)
+        if not ranges:
+            return False
+        i = bisect.bisect_right(ranges, [telegram_id, float("inf")]) - 1
+        return i >= 0 and ranges[i][0] <= telegram_id <= ranges[i][1]
+
+    def add(self, dialog_id, telegram_id):
+        if self.seen(dialog_id, telegram_id):
+            return
+        ranges = self.ranges.setdefault(dialog_id, [])
+        i = bisect.bisect_right(ranges, [telegram_id, float("inf")])
+        # склеиваем с соседними отрезками
+        if i > 0 and ranges[i - 1][1] == telegram_id - 1:
+            ranges[i - 1][1] = telegram_id
+            i -= 1
+        else:
+            ranges.insert(i, [telegram_id, telegram_id])
+        if i + 1 < len(ranges) and ranges[i + 1][0] == ranges[i][1] + 1:
+            ranges[i][1] = ranges.pop(i + 1)[1]
+        if len(ranges) > MAX_SEEN_RANGES:
+            # самые старые забываем: повтор всё равно отсечёт сервер по (dialog, telegram_id)
+            del ranges[:len(ranges) - MAX_SEEN_RANGES]
+        self.dirty = True
+
+    def trim(self, dialog_id, last_id):
+        """Забываем id не выше отметки синхронизации — они и так считаются сохранёнными."""
+        ranges = self.ranges.get(dialog_id)
+        if not ranges:
+            return
+        kept = [[max(lo, last_id + 1), hi] for lo, hi in ranges if hi > last_id]
+        if kept:
+            self.ranges[dialog_id] = kept
+        else:
+            del self.ranges[dialog_id]
+        self.dirty = True
+
+class BackfillState(JsonState):
+    """
+    Чекпоинты догрузки старой истории по диалогам: dialog_id -> {chat_id, offset_id},
+    где offset_id — самое старое уже сохранённое сообщение (0 — у нового диалога ещё не прочитана
+    даже последняя страница). Диалог, догруженный до начала, удаляется.
+    Сохраняется в файл, так что после падения догрузка продолжается с того же места.
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.jobs = self.data
+
+    def add(self, dialog_id, chat_id, offset_id):
+        if dialog_id not in self.jobs:
+            self.jobs[dialog_id] = {"chat_id": chat_id, "offset_id": offset_id}
+            self.dirty = True
+
+    def advance(self, dialog_id, offset_id):
+        self.jobs[dialog_id]["offset_id"] = offset_id
+        self.dirty = True
+
+    def finish(self, dialog_id):
+        self.jobs.pop(dialog_id, None)
+        self.dirty = True
+
+def local_media_path(file_url):
+    """
+    Путь к файлу Media в MEDIA_DIR по его file из API (абсолютный url или путь от MEDIA_URL).
+    None — если файла на этом хосте нет.
+    """
+    path = urlsplit(file_url).path
+    if not path.startswith(MEDIA_URL):
+        return None
+    root = os.path.realpath(MEDIA_DIR)
+    local = os.path.realpath(os.path.join(root, unquote(path[len(MEDIA_URL):])))
+    if not local.startswith(root + os.sep) or not os.path.isfile(local):
+        return None
+    return local
+
+class SendQueue(JsonState):
+    """
+    Локальная очередь повторов отправки: попытки по каждому сообщению из outbox Django.
+    После неудачи сообщение ждёт SEND_RETRY_BASE * 2^(попыток-1) секунд (не больше SEND_RETRY_MAX),
+    после SEND_MAX_ATTEMPTS неудач попадает в dead-letter и больше не отправляется — чтобы вечная ошибка
+    (например, удалённый чат) не тратила лимиты отправки. Чтобы отправить такое сообщение снова,
+    удалите его запись из файла очереди при остановленном мониторе.
+    Файлы для отправки берутся прямо из MEDIA_DIR; те, которых там нет, скачиваются с MEDIA_HOST
+    и лежат в files_dir, пока сообщение не отправлено или не брошено.
+    """
+    def __init__(self, path, files_dir):
+        super().__init__(path)
+        self.files_dir = files_dir
+        self.entries = self.data  # id сообщения -> {attempts, next_at, last_error, dead, files}
+
+    def due(self, message_id):
+        """Пора ли пробовать отправить сообщение."""
+        entry = self.entries.get(message_id)
+        return entry is None or (not entry["dead"] and entry["next_at"] <= time.time())
+
+    def dead_count(self):
+        return sum(entry["dead"] for entry in self.entries.values())
+
+    def _entry(self, message_id):
+        return self.entries.setdefault(message_id, {"attempts": 0, "next_at": 0, "last_error": None,
+                                                    "dead": False, "files": {}})
+
+    async def file(self, message_id, file_url):
+        """
+        Локальный путь файла для отправки: сам файл из MEDIA_DIR, если монитор работает на одном хосте
+        с Django, иначе скачанная копия — один раз на все попытки.
+        """
+        local = local_media_path(file_url)
+        if local is not None:
+            return local
+        url = file_url if urlsplit(file_url).scheme else MEDIA_HOST + file_url
+        entry = self._entry(message_id)
+        path = entry["files"].get(url)
+        if path and os.path.exists(path):
+            return path
+        os.makedirs(self.files_dir, exist_ok=True)
+        path = os.path.join(self.files_dir, f"{message_id}_{len(entry['files'])}{os.path.splitext(url)[-1]}")
+        if await api.download(url, path) is None:
+            raise RuntimeError(f"не удалось скачать файл {url}")
+        entry["files"][url] = path
+        self.dirty = True
+        return path
+
+    def failed(self, message_id, error):
+        """Учитывает неудачную попытку; возвращает True, если сообщение ушло в dead-letter."""
+        entry = self._entry(message_id)
+        entry["attempts"] += 1
+        entry["last_error"] = str(error)
+        if entry["attempts"] >= SEND_MAX_ATTEMPTS:
+            entry["dead"] = True
+            self._drop_files(entry)
+        else:
+            entry["next_at"] = time.time() + min(SEND_RETRY_BASE * 2 ** (entry["attempts"] - 1), SEND_RETRY_MAX)
+        self.dirty = True
+        return entry["dead"]
+
+    def succeeded(self, message_id):
+        entry = self.entries.pop(message_id, None)
+        if entry is not None:
+            self._drop_files(entry)
+            self.dirty = True
+
+    def retain(self, message_ids):
+        """Забывает сообщения, которых больше нет в outbox (доставлены или удалены в Django)."""
+        for message_id in set(self.entries) - set(message_ids):
+            self.succeeded(message_id)
+
+    def _drop_files(self, entry):
+        for path in entry["files"].values():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        entry["files"] = {}
+
+class DialogActivity:
+    """
+    Расписание чтения истории диалогов по давности последнего сообщения.
+    Интервал проверки — доля POLL_AGE_FACTOR от того, сколько диалог молчит (от POLL_MIN до POLL_MAX),
+    и после каждой пустой проверки он ещё удваивается; новое сообщение возвращает его к POLL_MIN.
+    Дата последнего сообщения берётся и из списка диалогов (top_message), так что после перезапуска
+    давно молчащий диалог сразу проверяется редко. Смена верхнего сообщения или счётчика
+    непрочитанных — повод проверить диалог сразу.
+    """
+    def __init__(self):
+        self.next_poll = {}  # dialog_id -> time.monotonic() следующей проверки
+        self.interval = {}  # dialog_id -> текущий интервал, секунд
+        self.last_active = {}  # dialog_id -> дата последнего сообщения (timestamp)
+        self.last_seen = {}  # dialog_id -> (top_message id, unread) из прошлого списка диалогов
+
+    def changed(self, dialog_id, top_id, unread, active_at=None):
+        """
+        Изменились ли верхнее сообщение или непрочитанные с прошлого раза; если да — диалог поднимается.
+        active_at — дата верхнего сообщения из списка диалогов.
+        """
+        self.active(dialog_id, active_at)
+        previous = self.last_seen.get(dialog_id)
+        self.last_seen[dialog_id] = (top_id, unread)
+        if previous is not None and previous != (top_id, unread):
+            self.interval[dialog_id] = POLL_MIN
+            self.next_poll[dialog_id] = 0
+            return True
+        return False
+
+    def active(self, dialog_id, active_at):
+        if active_at is not None and active_at > self.last_active.get(dialog_id, 0):
+            self.last_active[dialog_id] = active_at
+
+    def recency_interval(self, dialog_id):
+        """Интервал по давности последнего сообщения: чем дольше диалог молчит, тем реже проверяем."""
+        active_at = self.last_active.get(dialog_id)
+        if active_at is None:
+            return POLL_MIN
+        return min(POLL_MAX, max(POLL_MIN, (time.time() - active_at) * POLL_AGE_FACTOR))
+
+    def due(self, dialog_id):
+        return time.monotonic() >= self.next_poll.get(dialog_id, 0)
+
+    def record(self, dialog_id, active_at=None):
+        """После проверки: active_at — дата самого нового сообщения, если пришли новые."""
+        if active_at is not None:
+            self.active(dialog_id, active_at)
+            interval = self.recency_interval(dialog_id)
+        else:
+            interval = min(POLL_MAX, max(self.interval.get(dialog_id, 0) * 2, self.recency_interval(dialog_id)))
+        self.interval[dialog_id] = interval
+        self.next_poll[dialog_id] = time.monotonic() + interval
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst про запас."""
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """
+    Планировщик запросов одного аккаунта к Telegram.
+    У каждого вида запросов (REQUEST_LIMITS) свой бюджет, плюс общий бюджет аккаунта,
+    который раздаётся по приоритету: отправка раньше чтения истории.
+    FloodWait останавливает только свой вид запросов на время штрафа и вдвое снижает его темп;
+    после успешных запросов темп плавно возвращается к исходному.
+    """
+    def __init__(self, phone):
+        self.phone = phone
+        self.buckets = {kind: TokenBucket(rate, burst) for kind, (rate, burst) in REQUEST_LIMITS.items()}
+        self.account = TokenBucket(*ACCOUNT_LIMIT)
+        self.blocked_until = {}  # вид -> time.monotonic(), до которого действует штраф
+        self.flood_waits = defaultdict(int)  # вид -> сколько раз получили FloodWait
+        self.flood_seconds = defaultdict(int)  # вид -> сколько секунд штрафа набрали
+        self.queue = []  # (приоритет, номер) запросов, ждущих общего бюджета
+        self.counter = itertools.count()
+
+    def blocked(self, kind):
+        """Сколько ещё секунд действует штраф FloodWait для этого вида запросов."""
+        return max(0, self.blocked_until.get(kind, 0) - time.monotonic())
+
+    async def acquire(self, kind):
+        with metrics.timer("monitor_scheduler_wait_seconds", account=self.phone, kind=kind):
+            await self._acquire(kind)
+
+    async def _acquire(self, kind):
+        while self.blocked(kind):
+            await asyncio.sleep(self.blocked(kind))
+
+        bucket = self.buckets[kind]
+        while bucket.wait_time() > 0:
+            await asyncio.sleep(bucket.wait_time())
+        bucket.take()
+
+        entry = (REQUEST_PRIORITY[kind], next(self.counter))
+        heapq.heappush(self.queue, entry)
+        metrics.set("monitor_scheduler_queue", len(self.queue), account=self.phone)
+        try:
+            while True:
+                if self.queue[0] != entry:
+                    await asyncio.sleep(SCHEDULER_TICK)
+                elif self.account.wait_time() > 0:
+                    await asyncio.sleep(min(self.account.wait_time(), SCHEDULER_TICK))
+                else:
+                    self.account.take()
+                    return
+        finally:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            metrics.set("monitor_scheduler_queue", len(self.queue), account=self.phone)
+
+    def penalize(self, kind, seconds):
+        self.blocked_until[kind] = max(self.blocked_until.get(kind, 0), time.monotonic() + seconds)
+        self.flood_waits[kind] += 1
+        self.flood_seconds[kind] += seconds
+        metrics.inc("monitor_flood_waits_total", account=self.phone, kind=kind)
+        metrics.inc("monitor_flood_wait_seconds_total", seconds, account=self.phone, kind=kind)
+        bucket = self.buckets[kind]
+        bucket.rate = max(bucket.base_rate / 10, bucket.rate / 2)
+        print(f"[{self.phone}] FloodWait {seconds}s on {kind}, rate -> {bucket.rate:.2f}/s")
+
+    def succeeded(self, kind):
+        bucket = self.buckets[kind]
+        bucket.rate = min(bucket.base_rate, bucket.rate + bucket.base_rate / 20)
+
+    async def call(self, kind, func, *args, **kwargs):
+        """Один запрос к Telegram; короткий FloodWait пережидаем и повторяем."""
+        while True:
+            await self.acquire(kind)
+            try:
+                with metrics.timer("monitor_telegram_seconds", account=self.phone, kind=kind):
+                    result = await func(*args, **kwargs)
+            except FloodWait as e:
+                wait = int(e.value) + 1
+                self.penalize(kind, wait)
+                if wait > FLOOD_RETRY_MAX:
+                    raise
+                continue
+            self.succeeded(kind)
+            return result
+
+    async def iterate(self, kind, pages, page_size=100, limit=0):
+        """
+        Постраничный генератор Pyrogram (история, диалоги): по токену на каждую страницу.
+        limit — тот же, что передан в вызов Pyrogram: на нём генератор кончается, следующей страницы не будет.
+        """
+        await self.acquire(kind)
+        n = 0
+        spent = 0.0  # сколько ждали самих страниц от Telegram, без обработки у вызывающего
+        try:
+            start = time.monotonic()
+            async for item in pages:
+                spent += time.monotonic() - start
+                yield item
+                n += 1
+                if n % page_size == 0 and not (limit and n >= limit):
+                    await self.acquire(kind)
+                start = time.monotonic()
+            spent += time.monotonic() - start
+        except FloodWait as e:
+            self.penalize(kind, int(e.value) + 1)
+            raise
+        finally:
+            metrics.observe("monitor_telegram_seconds", spent, account=self.phone, kind=kind)
+        self.succeeded(kind)
+
 # --- Монитор для одного аккаунта ---
+def timed(stage):
+    """Декоратор метода AccountMonitor: время вызова — в monitor_stage_seconds{stage, account}."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            with metrics.timer("monitor_stage_seconds", stage=stage, account=self.phone):
+                return await func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class AccountMonitor:
-    def __init__(self, phone):
+    def __init__(self, phone, dialog_concurrency=DIALOG_CONCURRENCY, scan_interval=SCAN_INTERVAL):
         """
         phone должен быть в формате с '+' (тот, что в accounts.txt).
         Сессии в папке sessions хранятся без '+' — используем phone.replace("+","") как имя сессии.
+        dialog_concurrency — сколько диалогов синхронизируется одновременно в scan_once;
+        scan_interval — секунд между сканами (в push-режиме — между сверочными сканами).
         """
         self.phone = phone
+        self.scan_interval = scan_interval
         session_name = phone.replace("+", "")
-        self.client = Client(session_name, api_id=API_ID, api_hash=API_HASH, workdir=SESSIONS_DIR)
-        self.seen_messages = set()  # локальный кэш id сообщений, чтобы не пересоздавать много раз
+        # sleep_threshold=0: Pyrogram не пережидает FloodWait сам, штрафы учитывает self.sched
+        self.client = Client(session_name, api_id=API_ID, api_hash=API_HASH, workdir=SESSIONS_DIR,
+                             sleep_threshold=0)
+        self.sched = RequestScheduler(phone)
+        # уже сохранённые id сообщений, чтобы не пересоздавать много раз
+        self.seen = SeenTracker(os.path.join(STATE_DIR, f"seen_{session_name}.json"))
+        self.seen.load()
+        self.outbox = SendQueue(os.path.join(STATE_DIR, f"outbox_{session_name}.json"),
+                                os.path.join(OUTBOX_FILES_DIR, session_name))
+        self.outbox.load()
+        self.backfill = BackfillState(os.path.join(STATE_DIR, f"backfill_{session_name}.json"))
+        self.backfill.load()
+        self.backfill_added = asyncio.Event()  # будит run_backfill, когда появился новый диалог
+        self.tasks = []  # циклы аккаунта: сканы, отправка, догрузка истории
+        self.last_ids = {}  # dialog_id -> telegram_id последнего забранного сообщения
+        self.dialog_locks = defaultdict(asyncio.Lock)  # скан и апдейты не пишут один диалог одновременно
+        self.pending_albums = {}  # media_group_id -> части альбома, пришедшие апдейтами
+        self.album_tasks = set()  # ждущие сохранения альбомы: ссылки держим, чтобы задачи не собрал GC
         self.account_user_id = None
+        self.stats = defaultdict(int)  # счётчики для отчёта супервизору
+        self.scan_slots = asyncio.Semaphore(dialog_concurrency)
+        self.activity = DialogActivity()
+        self.roster = {}  # chat_id -> pyrogram Dialog (с top_message и непрочитанными) из последнего списка
+        self.roster_loaded_at = None  # time.monotonic() последнего полного списка диалогов
 
     async def start(self):
-        await self.client.start()
-        me = await self.client.get_me()
+        # без интерактивного входа: неавторизованная сессия не должна ждать ввода кода
+        await start_client(self.client)
+        me = self.client.me
         self.account_user_id = me.id
         print(f"[{self.phone}] client started as {me.first_name} ({self.account_user_id})")
+        # у каждого аккаунта свои циклы: долгий скан одного аккаунта не задерживает другие,
+        # а отправка не ждёт сканов своего
+        self.tasks = [asyncio.create_task(loop()) for loop in (self.run_scans, self.run_outbox, self.run_backfill)]
 
     def get_input_media(self,file_path, caption=None):
         """Определяем тип медиа по расширению"""
@@ -180,269 +937,759 @@ class AccountMonitor:
         else:
             return InputMediaDocument(file_path, caption=caption)
 
+    @timed("download_media")
+    async def download_media(self, msg, file_name):
+        path = await self.sched.call("download", self.client.download_media, msg, file_name=file_name)
+        if path:
+            metrics.inc("monitor_media_bytes_total", os.path.getsize(path), account=self.phone)
+        return path
+
     async def _extract_media_from_msg(self, msg):
         """
         Вспомогательная функция: извлекает медиа из одного сообщения
         """
         media_list = []
         try:
-            if msg.photo:
-                suffix = ".jpg"
-            elif msg.video:
-                suffix = ".mp4"
-            elif msg.voice:
-                suffix = ".ogg"
-            elif msg.video_note:
-                suffix = ".mp4"
-            elif msg.document:
-                suffix = os.path.splitext(msg.document.file_name or "")[1] or ".dat"
-            else:
-                return media_list  # нет медиа
-
-            # временный файл
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tf:
-                file_path = await self.client.download_media(msg, file_name=tf.name)
-                media_type = (
-                    "photo" if msg.photo else
-                    "video" if msg.video else
-                    "voice" if msg.voice else
-                    "video_note" if msg.video_note else
-                    "document"
-                )
-                media_list.append({"file_path": file_path, "media_type": media_type})
+            media = await media_store.fetch(self.download_media, msg)
+            if media:
+                media_list.append(media)
         except Exception as e:
             print(f"Ошибка скачивания медиа для msg {msg.id}: {e}")
         return media_list
-    async def get_media_files(self, msg):
-        """
-        Получает список медиа-файлов из сообщения или альбома.
-        client: pyrogram.Client
-        msg: pyrogram.types.Message
-        Возвращает список словарей {"file_path": ..., "media_type": ...}
-        """
-        media_list = []
-
-        # --- Если сообщение часть альбома ---
-        if msg.media_group_id:
-            # Получаем все сообщения в этом альбоме
-            album_msgs = [m async for m in self.client.get_chat_history(msg.chat.id, limit=100)
-                          if m.media_group_id == msg.media_group_id]
-
-            for m in album_msgs:
-                media_list.extend(await self._extract_media_from_msg(m))
-        else:
-            media_list.extend(await self._extract_media_from_msg(msg))
-
-        return media_list
 
     async def stop(self):
+        tasks = self.tasks + list(self.album_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         try:
             await self.client.stop()
         except Exception:
             pass
+        self.seen.save()
+        self.outbox.save()
+        self.backfill.save()
         print(f"[{self.phone}] client stopped")
 
-    async def scan_once(self):
+    @timed("send_outbox")
+    async def send_outbox(self):
+        """
+        Отправка в Telegram сообщений из Django (delivered=false) для этого аккаунта.
+        Неудачные попытки учитывает self.outbox: повтор с растущей паузой, потом dead-letter.
+        """
         try:
-            # Проходим по диалогам (limit ограничивает количество)
-            async for dialog in self.client.get_dialogs(limit=0):
-                chat = dialog.chat
-                chat_id = chat.id
-                # Сформируем читабельное название чата
-                chat_title = chat.title or ((chat.first_name or "") + (" " + chat.last_name if chat.last_name else "")) or str(chat_id)
-                dialog_id = create_dialog(self.phone, chat_id, chat_title)
-                if not dialog_id:
-                    continue
-
-                # Получаем историю (не очень большой лимит чтобы не получать FloodWait)
+            undelivered = await get_undelivered_messages_for_account(self.phone)
+            if undelivered is None:
+                return
+            self.outbox.retain(msg["id"] for msg in undelivered)
+            undelivered = [msg for msg in undelivered if self.outbox.due(msg["id"])]
+            if undelivered:
+                print(f"[{self.phone}] found {len(undelivered)} undelivered messages to send")
+            for msg in undelivered:
+                chat_id = msg["chat_id"]
                 try:
-                    # --- Отправка сообщений из Django для этого аккаунта ---
-                    undelivered = get_undelivered_messages_for_account(self.phone)
-                    if undelivered:
-                        print(f"[{self.phone}] found {len(undelivered)} undelivered messages to send")
-                    for msg in undelivered:
-                        try:
-                            # Получаем диалог, чтобы узнать chat_id
-                            try:
-                                dlg_resp = requests.get(f"{API_BASE}/dialogs/{msg['dialog']}/")
-
-                                dlg_resp.raise_for_status()
-                                dlg = dlg_resp.json()
-                                for d in dlg:
-                                    if d['id'] == msg['dialog']:
-                                        chat_id = d["chat_id"]
-                                        break
-                            except Exception as e:
-                                print(f"[{self.phone}] cannot fetch dialog {msg.get('dialog')}: {e}")
-                                continue
-
-                            if msg['media']:
-                                media_files = list(msg['media'])
-
-                                if len(media_files) == 1:
-                                    # Один файл → отправляем как фото/видео/документ
-                                    mf = media_files[0]
-                                    media = self.get_input_media(mf['file'], caption=msg['text'] or "")
-                                    print(f"http://5.129.253.254{mf['file']}")
-
-                                    url = f"http://5.129.253.254{mf['file']}"
-
-                                    # Скачиваем файл во временный
-                                    r = requests.get(url, stream=True)
-                                    if r.status_code != 200:
-                                        print(f"Не удалось скачать файл {url}")
-                                        continue
-
-                                    suffix = os.path.splitext(url)[-1]
-                                    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                                        for chunk in r.iter_content(1024):
-                                            tmp.write(chunk)
-                                        tmp_path = tmp.name
-                                    if isinstance(media, InputMediaPhoto):
-                                        await self.client.send_photo(chat_id, tmp_path,
-                                                                caption=msg['text'] or "")
-                                    elif isinstance(media, InputMediaVideo):
-                                        await self.client.send_video(chat_id, tmp_path,
-                                                                caption=msg['text'] or "")
-                                    else:
-                                        await self.client.send_document(chat_id, tmp_path,
-                                                                   caption=msg['text'] or "")
-                                else:
-                                    # Несколько файлов → альбом
-                                    # media_group = []
-                                    tmp_files = []
-                                    photos = []
-                                    videos = []
-                                    documents = []
-                                    for i, mf in enumerate(media_files):
-                                        caption = msg['text'] if i == 0 else None
-                                        print(f"http://5.129.253.254{mf['file']}")
-
-                                        url = f"http://5.129.253.254{mf['file']}"
-
-                                        # Скачиваем файл во временный
-                                        r = requests.get(url, stream=True)
-                                        if r.status_code != 200:
-                                            print(f"Не удалось скачать файл {url}")
-                                            continue
-
-                                        suffix = os.path.splitext(url)[-1]
-                                        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                                            for chunk in r.iter_content(1024):
-                                                tmp.write(chunk)
-                                            tmp.close()
-                                            tmp_files.append(tmp.name)
-                                        ext = tmp.name.lower().split(".")[-1]
-                                        if ext in ["jpg", "jpeg", "png", "gif", "webp"]:
-                                            photos.append(self.get_input_media(tmp.name, caption=caption))  # подпись только к первому
-                                        elif ext in ["mp4", "mov", "avi", "mkv"]:
-                                            videos.append(self.get_input_media(tmp.name, caption=caption))
-                                        else:
-                                            documents.append(self.get_input_media(tmp.name, caption=caption))
-
-                                        # media_group.append(self.get_input_media(tmp.name, caption=caption))
-                                    # print(media_group)
-                                    for media_group in [photos,videos]:
-                                        # print(f'{media_group} - {len(media_group)}')
-                                        if len(media_group) != 0:
-                                            await self.client.send_media_group(chat_id, media_group)
-                                    for doc in documents:
-                                        await self.client.send_document(chat_id,doc.media)
+                    if msg['media']:
+                        media_files = list(msg['media'])
+
+                        if len(media_files) == 1:
+                            # Один файл → отправляем как фото/видео/документ
+                            mf = media_files[0]
+                            media = self.get_input_media(mf['file'], caption=msg['text'] or "")
+                            # Файл из MEDIA_DIR или скачанный (один раз на все попытки отправки)
+                            file_path = await self.outbox.file(msg["id"], mf['file'])
+                            if isinstance(media, InputMediaPhoto):
+                                await self.sched.call("send", self.client.send_photo, chat_id, file_path,
+                                                      caption=msg['text'] or "")
+                            elif isinstance(media, InputMediaVideo):
+                                await self.sched.call("send", self.client.send_video, chat_id, file_path,
+                                                      caption=msg['text'] or "")
                             else:
-                                # Только текст
-                                await self.client.send_message(chat_id, msg['text'] or "")
-
-                            # Помечаем как доставленное
-                            mark_delivered(msg["id"], None)
-                            print(f"[{self.phone}] sent message {msg['id']} to chat {chat_id}")
-                        except FloodWait as e:
-                            wait = int(e.value) + 1
-                            print(f"[{self.phone}] FloodWait {wait}s while sending, sleeping...")
-                            await asyncio.sleep(wait)
-                        except Exception as e:
-                            print(f"[{self.phone}] Send error for message {msg.get('id')}: {e}")
-
-
-                    async for msg in self.client.get_chat_history(chat_id, limit=0):
-                        # Пропускаем системные пустые сообщения
-                        if not getattr(msg, "text", None) and not (getattr(msg, "media", None) or getattr(msg, "photo", None) or getattr(msg, "document", None)):
-                            continue
-
-                        # предотвращаем повторную обработку в рамках этого процесса
-                        unique_key = f"{self.phone}:{msg.id}"
-                        if unique_key in self.seen_messages:
-                            continue
-                        self.seen_messages.add(unique_key)
-
-                        # Подготовка полей
-                        date_iso = msg.date.isoformat()
-                        if getattr(msg, "from_user", None) and getattr(msg.from_user, "is_self", False):
-                            sender = "Я"
-                        elif getattr(msg, "from_user", None):
-                            sender = getattr(msg.from_user, "first_name", "Unknown")
+                                await self.sched.call("send", self.client.send_document, chat_id, file_path,
+                                                      caption=msg['text'] or "")
                         else:
-                            sender = "Unknown"
-                        text = getattr(msg, "text", "") or ""
-
-                        files = await self.get_media_files(msg)
-                        files_to_up = []
-                        for f in files:
-                            print(f"Файл: {f['file_path']}, тип: {f['media_type']}")
-
-                            files_to_up.append({"file_path":f['file_path'],'media_type':f['media_type']})
-
-                        # Создаём сообщение в Django (отмечаем как delivered=True т.к. это сообщение из Telegram)
-                        created = create_message(dialog_id, sender, text, date_iso,
-                                                 delivered=True, telegram_id=getattr(msg, "id", None),media=files_to_up)
-                        if created != False:
-                            print(f"[{self.phone}] created message in API dialog={dialog_id}, tg_id={getattr(msg,'id',None)}")
-                            # undelivered = get_undelivered_messages_for_account(self.phone)
-                            # if undelivered:
-                            #     print(f"[{self.phone}] найдено {len(undelivered)} недоставленных, ищем нужное подставляем медиа")
-                            # for msg in undelivered:
-                            #     if msg['dialog'] == dialog_id:
-                            #         if msg['text'] == text and msg['sender'] == sender:
-                            #             mark_delivered(msg,created['id'])
-                            #             print("Пометили с переносом текста..")
-                            #             break
+                            # Несколько файлов → альбом
+                            photos = []
+                            videos = []
+                            documents = []
+                            for i, mf in enumerate(media_files):
+                                caption = msg['text'] if i == 0 else None
+                                # Файл из MEDIA_DIR или скачанный (один раз на все попытки отправки)
+                                file_path = await self.outbox.file(msg["id"], mf['file'])
+                                ext = file_path.lower().split(".")[-1]
+                                if ext in ["jpg", "jpeg", "png", "gif", "webp"]:
+                                    photos.append(self.get_input_media(file_path, caption=caption))  # подпись только к первому
+                                elif ext in ["mp4", "mov", "avi", "mkv"]:
+                                    videos.append(self.get_input_media(file_path, caption=caption))
+                                else:
+                                    documents.append(self.get_input_media(file_path, caption=caption))
+
+                            for media_group in [photos,videos]:
+                                if len(media_group) != 0:
+                                    await self.sched.call("send", self.client.send_media_group, chat_id, media_group)
+                            for doc in documents:
+                                await self.sched.call("send", self.client.send_document, chat_id, doc.media)
+                    else:
+                        # Только текст
+                        await self.sched.call("send", self.client.send_message, chat_id, msg['text'] or "")
+
+                    # Помечаем как доставленное
+                    await mark_delivered(msg["id"], None)
+                    self.outbox.succeeded(msg["id"])
+                    print(f"[{self.phone}] sent message {msg['id']} to chat {chat_id}")
+                    self.count("sent")
                 except FloodWait as e:
-                    wait = int(e.value) + 1
-                    print(f"[{self.phone}] FloodWait {wait}s while fetching history for chat {chat_id}, sleeping...")
-                    await asyncio.sleep(wait)
+                    # отправка на штрафе — остальное отправим в следующих циклах, не блокируя скан
+                    print(f"[{self.phone}] FloodWait {e.value}s while sending, postponing outbox")
+                    break
                 except Exception as e:
-                    print(f"[{self.phone}] history loop error for chat {chat_id}: {e}")
+                    self.count("send_errors")
+                    if self.outbox.failed(msg["id"], e):
+                        print(f"[{self.phone}] message {msg.get('id')} moved to dead-letter after "
+                              f"{SEND_MAX_ATTEMPTS} attempts: {e}")
+                    else:
+                        print(f"[{self.phone}] Send error for message {msg.get('id')}: {e}")
+        except Exception as e:
+            print(f"[{self.phone}] outbox error:", e)
 
+    @timed("prepare_message")
+    async def prepare_message(self, dialog_id, parts):
+        """
+        Готовит сообщение Telegram к записи в Django (с уже скачанными медиа).
+        parts — одно сообщение или все части альбома: альбом сохраняется одним сообщением
+        с telegram_id первой части. Возвращает None для системных пустых сообщений.
+        """
+        msg = parts[0]
+        if len(parts) == 1 and not getattr(msg, "text", None) and not (getattr(msg, "media", None) or getattr(msg, "photo", None) or getattr(msg, "document", None)):
+            return None
+
+        # Подготовка полей
+        if getattr(msg, "from_user", None) and getattr(msg.from_user, "is_self", False):
+            sender = "Я"
+        elif getattr(msg, "from_user", None):
+            sender = getattr(msg.from_user, "first_name", "Unknown")
+        else:
+            sender = "Unknown"
+        # у альбома подпись обычно только у одной из частей
+        text = next((m.text or m.caption for m in parts if m.text or m.caption), "")
+
+        files = []
+        for media in await asyncio.gather(*[self._extract_media_from_msg(m) for m in parts]):
+            files.extend(media)
+        for f in files:
+            print(f"Файл: {f['file']}, тип: {f['media_type']}")
+
+        # delivered=True т.к. это сообщение из Telegram
+        return {
+            "dialog": dialog_id,
+            "sender_name": sender,
+            "text": text,
+            "date": msg.date.isoformat(),
+            "delivered": True,
+            "telegram_id": msg.id,
+            "media": files,
+        }
+
+    async def assemble_albums(self, msgs, kind="history", fetch_edges=True):
+        """
+        Собирает части альбомов (media_group_id) из потока сообщений (от старых к новым):
+        возвращает список групп, где обычное сообщение — группа из одного, альбом — группа из всех частей.
+        Альбомы на краях потока могли попасть в него не целиком — их дочитываем один раз через get_media_group
+        (запросом вида kind в планировщике); fetch_edges=False — альбомы уже собраны целиком.
+        """
+        groups = []
+        for msg in msgs:
+            if msg.media_group_id and groups and groups[-1][0].media_group_id == msg.media_group_id:
+                groups[-1].append(msg)
+            else:
+                groups.append([msg])
 
+        for i in sorted({0, len(groups) - 1}) if groups and fetch_edges else []:
+            if not groups[i][0].media_group_id:
+                continue
+            try:
+                album = await self.sched.call(kind, self.client.get_media_group,
+                                              groups[i][0].chat.id, groups[i][0].id)
+                groups[i] = sorted(album, key=lambda m: m.id)
+            except Exception as e:
+                print(f"[{self.phone}] cannot fetch album {groups[i][0].media_group_id}: {e}")
+        return groups
+
+    def is_seen(self, dialog_id, telegram_id):
+        last_id = self.last_ids.get(dialog_id)
+        return (last_id is not None and telegram_id <= last_id) or self.seen.seen(dialog_id, telegram_id)
+
+    @timed("ingest_messages")
+    async def ingest_messages(self, dialog_id, msgs, backfill=False, whole_albums=False):
+        """
+        Сохраняет сообщения Telegram (от старых к новым) в Django пачками по INGEST_BATCH.
+        Возвращает telegram_id последнего сохранённого по порядку сообщения
+        (None, если не сохранилось ни одного): после ошибки дальше не идём.
+        backfill — старая история ниже отметки: не отмечается в self.seen, повторы отсекает Django;
+        whole_albums — альбомы в msgs уже собраны целиком (апдейты), дочитывать края не нужно.
+        """
+        groups = await self.assemble_albums(msgs, "backfill" if backfill else "history", fetch_edges=not whole_albums)
+        done_id = None
+        for i in range(0, len(groups), INGEST_BATCH):
+            batch = groups[i:i + INGEST_BATCH]
+            # предотвращаем повторную обработку в рамках этого процесса
+            todo = [parts for parts in batch
+                    if backfill or not all(self.is_seen(dialog_id, m.id) for m in parts)]
+            # медиа пачки скачиваются параллельно (в пределах MEDIA_DOWNLOADS), порядок сохраняется
+            prepared = await asyncio.gather(*[self.prepare_message(dialog_id, parts) for parts in todo])
+            items = [item for item in prepared if item is not None]
+
+            if items:
+                result = await create_messages(items)
+                if result is None:
+                    break
+                if dialog_id in result.get("missing_dialogs", []):
+                    self.drop_dialog(dialog_id)
+                    break
+                for created in result["created"]:
+                    print(f"[{self.phone}] created message in API dialog={dialog_id}, tg_id={created['telegram_id']}")
+                self.count("backfilled" if backfill else "ingested", len(result["created"]))
+                if not backfill:
+                    for parts in todo:
+                        for m in parts:
+                            self.seen.add(dialog_id, m.id)
+            done_id = max(m.id for m in batch[-1])
+        return done_id
+
+    def drop_dialog(self, dialog_id):
+        """
+        Диалог удалён в Django: забываем его отметку, догрузку и сохранённые id. Следующий скан
+        создаст диалог заново (с новым id) и поставит его в догрузку с начала.
+        """
+        self.backfill.finish(dialog_id)
+        self.last_ids.pop(dialog_id, None)
+        if self.seen.ranges.pop(dialog_id, None) is not None:
+            self.seen.dirty = True
+        print(f"[{self.phone}] dialog {dialog_id} is gone in Django, dropped its sync state")
 
+    async def dialog_for_chat(self, chat):
+        """Находит/создаёт диалог в Django для чата Telegram и подтягивает его отметку синхронизации."""
+        dlg = await create_dialog(self.phone, chat.id, chat_title_of(chat))
+        if not dlg:
+            return None
+        if dlg["id"] not in self.last_ids:
+            self.last_ids[dlg["id"]] = dlg.get("last_telegram_id")
+        return dlg["id"]
+
+    @timed("sync_dialog")
+    async def sync_dialog(self, dialog):
+        """
+        Забирает из Telegram только сообщения новее сохранённой отметки диалога.
+        Новый диалог (без отметки) целиком уходит в фоновую догрузку (run_backfill): она прочитает
+        последнюю страницу, поставит отметку и дальше догрузит старую историю, не задерживая сканы.
+        """
+        chat_id = dialog.chat.id
+        dialog_id = await self.dialog_for_chat(dialog.chat)
+        if not dialog_id:
+            return
+
+        try:
+            async with self.dialog_locks[dialog_id]:
+                last_id = self.last_ids.get(dialog_id)
+                top = dialog.top_message
+                promoted = self.activity.changed(dialog_id, top.id if top else None, dialog.unread_messages_count,
+                                                 top.date.timestamp() if top and top.date else None)
+                if last_id is not None and top is not None and top.id <= last_id:
+                    return
+                if not promoted and not self.activity.due(dialog_id):
+                    # по списку диалогов не понять, есть ли новое (нет top_message или отметки) —
+                    # проверяем по расписанию активности
+                    return
+                if last_id is None:
+                    if dialog_id not in self.backfill.jobs:
+                        self.backfill.add(dialog_id, chat_id, 0)
+                        self.backfill_added.set()
+                        self.activity.record(dialog_id)
+                    return
+                if self.sched.blocked("history"):
+                    # история на штрафе FloodWait — не ждём, дочитаем в следующих сканах
+                    return
+
+                new_msgs = []
+                async for msg in self.sched.iterate("history", self.client.get_chat_history(chat_id)):
+                    if msg.id <= last_id:
+                        break
+                    new_msgs.append(msg)
+
+                # история идёт от новых к старым — создаём от старых к новым,
+                # чтобы отметка двигалась монотонно и при ошибке не было дыр
+                synced_id = await self.ingest_messages(dialog_id, new_msgs[::-1])
+                self.activity.record(dialog_id, new_msgs[0].date.timestamp() if new_msgs else None)
+                if synced_id is not None and synced_id != last_id:
+                    self.last_ids[dialog_id] = synced_id
+                    self.seen.trim(dialog_id, synced_id)
+                    await save_sync_state(dialog_id, synced_id)
+        except FloodWait as e:
+            # история на штрафе (см. RequestScheduler) — диалог дочитаем в следующих сканах
+            print(f"[{self.phone}] FloodWait {e.value}s while fetching history for chat {chat_id}")
+        except Exception as e:
+            print(f"[{self.phone}] history loop error for chat {chat_id}: {e}")
+
+    async def run_backfill(self):
+        """
+        Фоновая загрузка истории новых диалогов, отдельно от сканов новых сообщений:
+        по странице BACKFILL_PAGE на диалог за проход, запросами вида "backfill" — самого низкого приоритета,
+        так что чтение новых сообщений и отправка их всегда опережают. Первые страницы новых диалогов
+        читаются раньше догрузки старой истории. Чекпоинты — в self.backfill.
+        """
+        while True:
+            jobs = sorted(self.backfill.jobs.items(), key=lambda item: item[1]["offset_id"] != 0)
+            for dialog_id, job in jobs:
+                if self.sched.blocked("backfill"):
+                    break
+                try:
+                    await self.backfill_page(dialog_id, job)
+                except FloodWait as e:
+                    print(f"[{self.phone}] FloodWait {e.value}s while backfilling, pausing")
+                    break
+                except Exception as e:
+                    print(f"[{self.phone}] backfill error for dialog {dialog_id}: {e}")
+            self.backfill.save()
+            self.backfill_added.clear()
+            try:
+                await asyncio.wait_for(self.backfill_added.wait(),
+                                       BACKFILL_INTERVAL if self.backfill.jobs else BACKFILL_IDLE)
+            except asyncio.TimeoutError:
+                pass
+
+    @timed("backfill_page")
+    async def backfill_page(self, dialog_id, job):
+        """
+        Одна страница истории старше чекпоинта: сохраняет её пачками и сдвигает чекпоинт.
+        Первая страница нового диалога (offset_id 0) заодно ставит отметку синхронизации — дальше
+        новые сообщения читает sync_dialog.
+        """
+        first = job["offset_id"] == 0
+        async with contextlib.AsyncExitStack() as stack:
+            if first:
+                # первая страница и отметка — под замком диалога, как в sync_dialog
+                await stack.enter_async_context(self.dialog_locks[dialog_id])
+            msgs = []
+            async for msg in self.sched.iterate("backfill", self.client.get_chat_history(
+                    job["chat_id"], limit=BACKFILL_PAGE, offset_id=job["offset_id"]),
+                    page_size=BACKFILL_PAGE, limit=BACKFILL_PAGE):
+                msgs.append(msg)
+            if msgs:
+                done_id = await self.ingest_messages(dialog_id, msgs[::-1], backfill=True)
+                if done_id is None or done_id < msgs[0].id:
+                    # страница сохранилась не вся — повторим её в следующем проходе
+                    return
+                if first:
+                    self.last_ids[dialog_id] = msgs[0].id
+                    self.seen.trim(dialog_id, msgs[0].id)
+                    self.activity.record(dialog_id, msgs[0].date.timestamp())
+                    await save_sync_state(dialog_id, msgs[0].id)
+        if len(msgs) < BACKFILL_PAGE:
+            self.backfill.finish(dialog_id)
+            print(f"[{self.phone}] backfill of dialog {dialog_id} finished")
+        else:
+            self.backfill.advance(dialog_id, msgs[-1].id)
+
+    def count(self, event, n=1):
+        """Счётчик для отчёта супервизору и метрик."""
+        self.stats[event] += n
+        metrics.inc("monitor_events_total", n, account=self.phone, event=event)
+
+    def report_metrics(self):
+        """Текущие размеры очередей аккаунта — в метрики."""
+        metrics.set("monitor_outbox_retrying", len(self.outbox.entries) - self.outbox.dead_count(), account=self.phone)
+        metrics.set("monitor_outbox_dead_letters", self.outbox.dead_count(), account=self.phone)
+        metrics.set("monitor_backfill_dialogs", len(self.backfill.jobs), account=self.phone)
+        metrics.set("monitor_dialogs", len(self.roster), account=self.phone)
+        metrics.set("monitor_pending_albums", len(self.pending_albums), account=self.phone)
+
+    def status(self):
+        """Состояние аккаунта для отчёта супервизору."""
+        return {
+            "started": self.account_user_id is not None,
+            **self.stats,
+            "dead_letters": self.outbox.dead_count(),
+            "backfill_dialogs": len(self.backfill.jobs),
+            "flood_waits": sum(self.sched.flood_waits.values()),
+            "flood_seconds": sum(self.sched.flood_seconds.values()),
+        }
+
+    async def run_scans(self):
+        """Сканы диалогов раз в scan_interval секунд."""
+        while True:
+            try:
+                await self.scan_once()
+                self.seen.save()
+            except Exception as e:
+                print(f"[{self.phone}] scan loop error:", e)
+            await asyncio.sleep(self.scan_interval)
+
+    async def run_outbox(self):
+        """Отправка outbox раз в SCAN_INTERVAL секунд, независимо от сканов."""
+        while True:
+            try:
+                await self.send_outbox()
+                self.outbox.save()
+            except Exception as e:
+                print(f"[{self.phone}] outbox loop error:", e)
+            await asyncio.sleep(SCAN_INTERVAL)
+
+    @timed("scan")
+    async def scan_once(self):
+        self.count("scans")
+        if self.sched.blocked("dialogs"):
+            return
+        # полный список диалогов — при старте и раз в ROSTER_REFRESH, иначе только первая страница:
+        # Telegram сортирует диалоги по последней активности, так что всё новое окажется на ней
+        full = self.roster_loaded_at is None or time.monotonic() - self.roster_loaded_at >= ROSTER_REFRESH
+        fresh = {}
+        tasks = []
+        limit = 0 if full else ROSTER_PAGE
+        try:
+            async for dialog in self.sched.iterate("dialogs", self.client.get_dialogs(limit=limit), limit=limit):
+                fresh[dialog.chat.id] = dialog
+                await self._schedule_sync(dialog, tasks)
+            if full:
+                self.roster = fresh
+                self.roster_loaded_at = time.monotonic()
+            else:
+                self.roster.update(fresh)
+                # остальные диалоги берём из кэша: верхнее сообщение у них не менялось,
+                # проверяем только те, что ждут проверки по расписанию активности
+                for chat_id, dialog in list(self.roster.items()):
+                    if chat_id not in fresh and self.roster_due(dialog):
+                        await self._schedule_sync(dialog, tasks)
         except Exception as e:
             print(f"[{self.phone}] scan error:", e)
+        finally:
+            await asyncio.gather(*tasks)
 
+    def roster_due(self, dialog):
+        """Нужно ли проверить диалог из кэша списка (его нет на свежей первой странице)."""
+        dlg = dialog_index.get(self.phone, dialog.chat.id)
+        if not dlg:
+            return True
+        last_id = self.last_ids.get(dlg["id"])
+        top = dialog.top_message
+        if last_id is not None and top is not None and top.id <= last_id:
+            return False
+        return self.activity.due(dlg["id"])
 
-# --- Главный цикл ---
-async def run_loop():
-    monitors = [AccountMonitor(phone) for phone in ACCOUNTS]
-    # старт всех клиентов
-    for m in monitors:
-        print(m.phone)
+    async def _schedule_sync(self, dialog, tasks):
+        # одновременно синхронизируем не больше scan_slots диалогов,
+        # порядок сообщений внутри чата сохраняет sync_dialog, темп — self.sched
+        await self.scan_slots.acquire()
+        tasks.append(asyncio.create_task(self._sync_dialog_slot(dialog)))
+
+    async def _sync_dialog_slot(self, dialog):
         try:
-            await m.start()
+            await self.sync_dialog(dialog)
+        finally:
+            self.scan_slots.release()
+
+    # --- Push-режим: обработчики обновлений Pyrogram ---
+    def add_handlers(self):
+        self.client.add_handler(MessageHandler(self._on_new_message))
+        self.client.add_handler(EditedMessageHandler(self._on_edited_message))
+
+    async def _on_new_message(self, client, msg):
+        if msg.media_group_id:
+            # части альбома приходят отдельными апдейтами — собираем их и сохраняем разом
+            album = self.pending_albums.setdefault(msg.media_group_id, [])
+            album.append(msg)
+            if len(album) == 1:
+                task = asyncio.create_task(self._flush_album(msg.media_group_id))
+                self.album_tasks.add(task)
+                task.add_done_callback(self.album_tasks.discard)
+            return
+        await self._ingest_updates([msg])
+
+    async def _flush_album(self, media_group_id):
+        await asyncio.sleep(ALBUM_WAIT)
+        album = self.pending_albums.pop(media_group_id, [])
+        await self._ingest_updates(sorted(album, key=lambda m: m.id))
+
+    async def _ingest_updates(self, msgs):
+        """
+        Сохраняет сообщения, пришедшие апдейтом. Отметку синхронизации не двигаем:
+        апдейты могут теряться, отметку подтверждает сверочный скан (он пропустит уже сохранённое).
+        """
+        try:
+            dialog_id = await self.dialog_for_chat(msgs[0].chat)
+            if not dialog_id:
+                return
+            async with self.dialog_locks[dialog_id]:
+                # альбом из апдейтов уже собран в _flush_album — без лишнего get_media_group
+                await self.ingest_messages(dialog_id, msgs, whole_albums=True)
+        except FloodWait as e:
+            # не сохранилось — подберёт сверочный скан
+            print(f"[{self.phone}] FloodWait {e.value}s while handling update")
+        except Exception as e:
+            print(f"[{self.phone}] update handler error: {e}")
+
+    async def _on_edited_message(self, client, msg):
+        try:
+            dialog_id = await self.dialog_for_chat(msg.chat)
+            if dialog_id:
+                await update_message_text(dialog_id, msg.id, msg.text or msg.caption or "")
         except Exception as e:
-            print(f"Failed to start monitor for {m.phone}: {e}")
+            print(f"[{self.phone}] edit handler error: {e}")
+
+
+# --- Главный цикл ---
+async def run_loop(push=False, accounts=None, status_queue=None, worker=0, dialog_concurrency=DIALOG_CONCURRENCY,
+                   workers=0, metrics_port=METRICS_PORT):
+    """
+    accounts — фиксированный список номеров; по умолчанию аккаунты берутся из sessions/
+    и подхватываются или останавливаются на ходу, когда файлы сессий появляются или исчезают;
+    workers — в режиме супервизора: процесс ведёт только аккаунты с shard_of(phone, workers) == worker;
+    status_queue — очередь отчётов супервизору (в режиме --workers);
+    metrics_port — порт /metrics для Prometheus (0 — не открывать).
+    """
+    monitors = {}  # phone -> запущенный AccountMonitor
+    retiring = set()  # сессии удалены: главный цикл остановит эти аккаунты
+    retry_at = {}  # phone -> time.monotonic(), раньше которого не пробуем снова запустить аккаунт
+    # старт клиентов параллельно: зависший аккаунт не задерживает остальные
+    startup_slots = asyncio.Semaphore(STARTUP_CONCURRENCY)
 
+    async def start_monitor(m):
+        async with startup_slots:
+            try:
+                if push:
+                    m.add_handlers()
+                await asyncio.wait_for(m.start(), STARTUP_TIMEOUT)
+                return True
+            except asyncio.TimeoutError:
+                print(f"Failed to start monitor for {m.phone}: no answer in {STARTUP_TIMEOUT}s")
+            except Exception as e:
+                print(f"Failed to start monitor for {m.phone}: {e}")
+        try:
+            await m.client.disconnect()
+        except Exception:
+            pass
+        return False
+
+    def wanted_accounts(settle=0):
+        if accounts is not None:
+            return set(accounts)
+        return {phone for phone in list_accounts(settle) if not workers or shard_of(phone, workers) == worker}
+
+    async def reconcile():
+        """Запускает аккаунты с новыми сессиями и помечает к остановке те, чьи сессии удалены."""
+        # Pyrogram сам переписывает файл сессии работающего аккаунта, так что свежий mtime
+        # не повод его останавливать: остановка — только когда файла больше нет
+        retiring.clear()
+        retiring.update(set(monitors) - wanted_accounts())
+        wanted = wanted_accounts(SESSION_SETTLE)
+        now = time.monotonic()
+        scan_interval = RECONCILE_INTERVAL if push else SCAN_INTERVAL
+        new = [AccountMonitor(phone, dialog_concurrency, scan_interval) for phone in sorted(wanted - set(monitors))
+               if retry_at.get(phone, 0) <= now]
+        if not new:
+            return
+        started = await asyncio.gather(*[start_monitor(m) for m in new])
+        for m, ok in zip(new, started):
+            if ok:
+                monitors[m.phone] = m
+                retry_at.pop(m.phone, None)
+            else:
+                retry_at[m.phone] = time.monotonic() + ACCOUNT_RETRY
+        failed = [m.phone for m, ok in zip(new, started) if not ok]
+        print(f"Started {sum(started)} of {len(started)} accounts" + (f", failed: {', '.join(failed)}" if failed else ""))
+
+    async def watch_sessions():
+        while True:
+            await asyncio.sleep(SESSIONS_WATCH)
+            try:
+                await reconcile()
+            except Exception as e:
+                print(f"Failed to check sessions: {e}")
+
+    async def report_status():
+        """
+        Отчёт супервизору раз в STATUS_INTERVAL — своей задачей с самого старта процесса, чтобы долгий
+        запуск аккаунтов не выглядел как зависание. Отчёты прекращаются, только если встал сам event loop.
+        """
+        while True:
+            status_queue.put({
+                "worker": worker,
+                "pid": os.getpid(),
+                "time": time.time(),
+                "accounts": {m.phone: m.status() for m in monitors.values()},
+            })
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    # SIGTERM (так супервизор останавливает воркер) — как Ctrl+C: аккаунты останавливаются и сохраняют состояние
+    with contextlib.suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+    background = []
+    if status_queue is not None:
+        background.append(asyncio.create_task(report_status()))
+    metrics_server = None
     try:
+        await dialog_index.load()
+        if metrics_port:
+            try:
+                metrics_server = await metrics.serve(metrics_port)
+                print(f"Metrics: http://{METRICS_HOST}:{metrics_port}/metrics")
+            except OSError as e:
+                print(f"Failed to open metrics port {metrics_port}: {e}")
+
+        await reconcile()
+        background.append(asyncio.create_task(watch_sessions()))
+        last_metrics_log = time.monotonic()
         while True:
-            tasks = [m.scan_once() for m in monitors]
-            # параллельно запускаем сканы
-            await asyncio.gather(*tasks)
-            await asyncio.sleep(3)
-    except KeyboardInterrupt:
+            # сканы и отправку каждый аккаунт ведёт сам (AccountMonitor.run_scans / run_outbox),
+            # здесь — только остановка удалённых аккаунтов, метрики и отчёты
+            for phone in list(retiring):
+                m = monitors.pop(phone, None)
+                if m is not None:
+                    print(f"[{phone}] session removed, stopping")
+                    try:
+                        await m.stop()
+                    except Exception as e:
+                        print(f"[{phone}] failed to stop: {e}")
+                    metrics.forget(account=phone)
+            retiring.clear()
+            for m in monitors.values():
+                m.report_metrics()
+            metrics.set("monitor_accounts", len(monitors))
+            metrics.set("monitor_media_downloads_pending", len(media_store.pending))
+            if time.monotonic() - last_metrics_log >= METRICS_LOG_INTERVAL:
+                last_metrics_log = time.monotonic()
+                print(json.dumps({"event": "metrics", "time": time.time(), "worker": worker, **metrics.summary()},
+                                 ensure_ascii=False))
+            await asyncio.sleep(SCAN_INTERVAL)
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print("Stopping monitors...")
     finally:
-        for m in monitors:
+        for task in background:
+            task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        for m in monitors.values():
             try:
                 await m.stop()
             except Exception:
                 pass
+        api.close()
+
+def run_worker(worker, workers, push, status_queue, dialog_concurrency, metrics_port):
+    """Точка входа процесса-воркера супервизора."""
+    try:
+        asyncio.run(run_loop(push=push, status_queue=status_queue, worker=worker,
+                             dialog_concurrency=dialog_concurrency, workers=workers,
+                             metrics_port=metrics_port + worker if metrics_port else 0))
+    except KeyboardInterrupt:
+        pass
+
+def supervise(workers, push=False, dialog_concurrency=DIALOG_CONCURRENCY, metrics_port=METRICS_PORT):
+    """
+    Делит аккаунты из sessions/ между workers процессами, перезапускает упавшие и зависшие
+    и сводит их отчёты в один: печатает сводку и пишет её в STATUS_FILE.
+    Аккаунт закреплён за воркером по shard_of, так что новые сессии воркеры подхватывают сами.
+    """
+    status_queue = multiprocessing.Queue()
+    processes = {}
+    reports = {}
+    restarts = defaultdict(int)
+
+    def start(worker):
+        p = multiprocessing.Process(target=run_worker,
+                                    args=(worker, workers, push, status_queue, dialog_concurrency, metrics_port),
+                                    name=f"monitor-{worker}", daemon=True)
+        p.start()
+        processes[worker] = p
+        reports[worker] = {"worker": worker, "pid": p.pid, "time": time.time(), "accounts": {}}
+        shard = [phone for phone in list_accounts() if shard_of(phone, workers) == worker]
+        print(f"[supervisor] worker {worker} (pid {p.pid}): {', '.join(shard) or '-'}")
+
+    for worker in range(workers):
+        start(worker)
+
+    last_summary = time.time()
+    try:
+        while True:
+            try:
+                report = status_queue.get(timeout=1)
+                reports[report["worker"]] = report
+            except queue.Empty:
+                pass
+
+            for worker, p in list(processes.items()):
+                if not p.is_alive():
+                    print(f"[supervisor] worker {worker} exited with code {p.exitcode}, restarting")
+                elif time.time() - reports[worker]["time"] > WORKER_TIMEOUT:
+                    print(f"[supervisor] worker {worker} has not reported for {WORKER_TIMEOUT}s, restarting")
+                    stop_workers([p])
+                else:
+                    continue
+                restarts[worker] += 1
+                time.sleep(RESTART_DELAY)
+                start(worker)
+
+            if time.time() - last_summary >= STATUS_INTERVAL:
+                last_summary = time.time()
+                write_status(processes, reports, restarts)
+    except KeyboardInterrupt:
+        print("[supervisor] stopping workers...")
+    finally:
+        stop_workers(processes.values())
+
+def stop_workers(processes):
+    """
+    SIGTERM воркерам и ожидание, пока они остановят аккаунты и сохранят состояние;
+    не успевшие за WORKER_STOP_TIMEOUT секунд завершаются принудительно.
+    """
+    for p in processes:
+        p.terminate()
+    deadline = time.time() + WORKER_STOP_TIMEOUT
+    for p in processes:
+        p.join(max(0, deadline - time.time()))
+        if p.is_alive():
+            print(f"[supervisor] worker pid {p.pid} did not stop in {WORKER_STOP_TIMEOUT}s, killing")
+            p.kill()
+            p.join()
+
+def write_status(processes, reports, restarts):
+    """Сводка по всем воркерам: в консоль и в STATUS_FILE."""
+    totals = defaultdict(int)
+    workers = []
+    for worker, p in sorted(processes.items()):
+        report = reports[worker]
+        for stats in report["accounts"].values():
+            for key, value in stats.items():
+                if not isinstance(value, bool):
+                    totals[key] += value
+        workers.append({
+            "worker": worker,
+            "pid": p.pid,
+            "alive": p.is_alive(),
+            "restarts": restarts[worker],
+            "last_report": report["time"],
+            "accounts": report["accounts"],
+        })
+    print(f"[supervisor] workers alive: {sum(w['alive'] for w in workers)}/{len(workers)}, "
+          + ", ".join(f"{k}={v}" for k, v in sorted(totals.items())))
+    tmp = STATUS_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"time": time.time(), "totals": totals, "workers": workers}, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, STATUS_FILE)
 
 if __name__ == "__main__":
-    asyncio.run(run_loop())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--push", action="store_true",
+                        help="получать новые сообщения апдейтами, полный скан раз в RECONCILE_INTERVAL секунд")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="разделить аккаунты между столькими процессами под присмотром супервизора")
+    parser.add_argument("--dialog-concurrency", type=int, default=DIALOG_CONCURRENCY,
+                        help="сколько диалогов одного аккаунта синхронизировать одновременно")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="порт /metrics для Prometheus (у воркеров --workers: этот порт + номер воркера), 0 — выключить")
+    args = parser.parse_args()
+    if args.workers > 0:
+        supervise(args.workers, push=args.push, dialog_concurrency=args.dialog_concurrency,
+                  metrics_port=args.metrics_port)
+    else:
+        asyncio.run(run_loop(push=args.push, dialog_concurrency=args.dialog_concurrency,
+                             metrics_port=args.metrics_port))
@@ -1,6 +1,8 @@
 import os
+import argparse
+import asyncio
 import builtins
-from pyrogram import Client, errors
+from pyrogram import Client, errors, raw
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SESSIONS_DIR = os.path.join(BASE_DIR, "sessions")
@@ -8,6 +10,9 @@ os.makedirs(SESSIONS_DIR, exist_ok=True)
 
 API_FILE = os.path.join(BASE_DIR, "api.txt")
 
+CHECK_CONCURRENCY = 10  # сессий, проверяемых одновременно
+CHECK_TIMEOUT = 30  # секунд на проверку одной сессии
+
 # Читаем API_ID и API_HASH
 with open(API_FILE) as f:
     API_ID = int(f.readline().strip())
@@ -45,5 +50,62 @@ def add_session():
         # Восстанавливаем стандартный input
         builtins.input = orig_input
 
+async def start_client(client):
+    """
+    То же, что client.start(), но без интерактивного входа:
+    для неавторизованной сессии не спрашивает номер и код, а выбрасывает ошибку.
+    """
+    if not await client.connect():
+        await client.disconnect()
+        raise RuntimeError("сессия не авторизована")
+    try:
+        await client.invoke(raw.functions.updates.GetState())
+    except BaseException:
+        await client.disconnect()
+        raise
+    client.me = await client.get_me()
+    await client.initialize()
+    return client
+
+async def check_session(session_name, slots, timeout=CHECK_TIMEOUT):
+    """Проверяет одну сессию: (имя, валидна ли, описание)."""
+    async with slots:
+        app = Client(session_name, api_id=API_ID, api_hash=API_HASH, workdir=SESSIONS_DIR, no_updates=True)
+        try:
+            await asyncio.wait_for(start_client(app), timeout)
+        except asyncio.TimeoutError:
+            return session_name, False, f"нет ответа за {timeout} с"
+        except Exception as e:
+            return session_name, False, f"{type(e).__name__}: {e}"
+        try:
+            return session_name, True, f"{app.me.first_name} ({app.me.id})"
+        finally:
+            try:
+                await app.stop()
+            except Exception:
+                pass
+
+async def check_sessions(concurrency=CHECK_CONCURRENCY, timeout=CHECK_TIMEOUT):
+    """
+    Без участия пользователя проверяет все .session в SESSIONS_DIR одновременно
+    (не больше concurrency) и печатает, какие из них рабочие. Возвращает список результатов.
+    """
+    names = sorted(f[:-len(".session")] for f in os.listdir(SESSIONS_DIR) if f.endswith(".session"))
+    slots = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[check_session(name, slots, timeout) for name in names])
+    for name, ok, info in results:
+        print(f"[{'+' if ok else '-'}] {name}: {info}")
+    print(f"[i] Рабочих сессий: {sum(ok for _, ok, _ in results)} из {len(results)}")
+    return results
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true",
+                        help="проверить все сессии в sessions/ без интерактивного входа (монитор лучше остановить)")
+    parser.add_argument("--concurrency", type=int, default=CHECK_CONCURRENCY)
+    parser.add_argument("--timeout", type=float, default=CHECK_TIMEOUT)
+    args = parser.parse_args()
+    if args.check:
+        results = asyncio.run(check_sessions(args.concurrency, args.timeout))
+        raise SystemExit(0 if all(ok for _, ok, _ in results) else 1)
     add_session()
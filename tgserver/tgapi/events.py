@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+
+class Subscription:
+    """Очередь событий одного подписчика с фильтром по диалогу и/или аккаунту."""
+    def __init__(self, loop, dialog_id=None, account_phone=None, maxsize=1000):
+        self.loop = loop
+        self.dialog_id = dialog_id
+        self.account_phone = account_phone
+        self.queue = asyncio.Queue(maxsize)
+        self.overflow = False  # подписчик не успевал читать и пропустил события
+
+    def wants(self, event):
+        if self.dialog_id is not None and event["dialog"] != self.dialog_id:
+            return False
+        if self.account_phone is not None and event.get("account_phone") != self.account_phone:
+            return False
+        return True
+
+    def put(self, event):
+        # вызывается в event loop подписчика
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflow = True
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    Брокер событий внутри процесса (достаточно для одного узла): синхронный код Django публикует,
+    асинхронные потоки SSE читают. Публиковать можно из любого потока — событие передаётся
+    в event loop подписчика через call_soon_threadsafe.
+    """
+    def __init__(self):
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self, dialog_id=None, account_phone=None):
+        subscription = Subscription(asyncio.get_running_loop(), dialog_id, account_phone)
+        with self.lock:
+            self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self.subscriptions)
+
+    def publish(self, events):
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            for event in events:
+                if subscription.wants(event):
+                    try:
+                        subscription.loop.call_soon_threadsafe(subscription.put, event)
+                    except RuntimeError:
+                        # loop подписчика уже закрыт
+                        self.unsubscribe(subscription)
+                        break
+
+
+broker = Broker()
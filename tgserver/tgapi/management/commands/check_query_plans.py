@@ -0,0 +1,82 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from tgapi.models import Dialog, Message, MessageChange
+from tgapi.views import DialogListCreateView
+
+
+# полный проход по таблице без индекса: SQLite — "SCAN <таблица>" без USING INDEX, PostgreSQL — Seq Scan
+FULL_SCAN = {
+    "sqlite": r"SCAN (tgapi_message|tgapi_messagechange)\b(?! USING (COVERING )?INDEX)",
+    "postgresql": r"Seq Scan on (tgapi_message|tgapi_messagechange)\b",
+}
+# индекс UniqueConstraint(dialog, telegram_id): SQLite создаёт его вместе с таблицей под своим именем
+UNIQUE_TELEGRAM_ID = r"unique_dialog_telegram_id|sqlite_autoindex_tgapi_message_\d+"
+
+
+class Command(BaseCommand):
+    help = ("Печатает планы запросов горячих эндпоинтов tgapi и падает, если какой-то из них читает "
+            "таблицу сообщений целиком или идёт не по тому индексу, который для него заведён.")
+
+    def hot_queries(self):
+        """
+        Запросы в том виде, в каком их строят tgapi.views (на первом попавшемся диалоге), и индексы,
+        которые должны быть в плане: каждый элемент — регулярное выражение с допустимыми вариантами
+        (выбор между ними зависит от статистики планировщика).
+        """
+        dialog = Dialog.objects.order_by("id").first()
+        dialog_id = dialog.id if dialog else 0
+        account_phone = dialog.account_phone if dialog else ""
+        return {
+            "GET /api/messages/?dialog= (последняя страница)": (
+                Message.objects.filter(dialog_id=dialog_id).order_by("-date", "-id")[:100],
+                ["message_dialog_date"]),
+            "GET /api/messages/?dialog=&before=": (
+                Message.objects.filter(dialog_id=dialog_id, date__lt=timezone.now()).order_by("-date", "-id")[:100],
+                ["message_dialog_date"]),
+            "GET /api/messages/?dialog=&telegram_id=": (
+                Message.objects.filter(dialog_id=dialog_id, telegram_id=1),
+                [UNIQUE_TELEGRAM_ID]),
+            "GET /api/messages/?from_gui (отметка прочитанными)": (
+                Message.objects.filter(dialog_id=dialog_id, is_read=False),
+                ["message_dialog_is_read|message_dialog_date"]),
+            "GET /api/messages/?delivered=": (
+                Message.objects.filter(delivered=False),  # порядок — Meta.ordering, как во view
+                ["message_outbox"]),
+            "GET /api/outbox/?account_phone=": (
+                Message.objects.filter(delivered=False, dialog__account_phone=account_phone).order_by("date", "id"),
+                ["message_outbox"]),
+            "POST /api/messages/bulk/ (уже сохранённые)": (
+                Message.objects.filter(dialog_id=dialog_id, telegram_id__in=[1, 2, 3]).values_list("id", "telegram_id"),
+                [UNIQUE_TELEGRAM_ID + "|message_dialog_date"]),
+            "GET /api/dialogs/ (последнее сообщение и непрочитанные)": (
+                DialogListCreateView().get_queryset().order_by("-activity", "-id")[:100],
+                ["message_dialog_date", "message_dialog_is_read|message_dialog_date"]),
+            "GET /api/messages/changes/?dialog=&since=": (
+                MessageChange.objects.filter(dialog_id=dialog_id, id__gt=0).order_by("id"),
+                ["messagechange_dialog_id"]),
+        }
+
+    def handle(self, *args, **options):
+        pattern = FULL_SCAN.get(connection.vendor)
+        if pattern is None:
+            raise CommandError(f"нет правила для {connection.vendor}")
+        failed = []
+        for name, (queryset, indexes) in self.hot_queries().items():
+            plan = queryset.explain()
+            if re.search(pattern, plan):
+                verdict = "FULL SCAN"
+            else:
+                missing = [index for index in indexes if not re.search(rf"\b({index})\b", plan)]
+                verdict = f"NO INDEX {', '.join(missing)}" if missing else "ok"
+            self.stdout.write(f"{verdict}: {name}")
+            for line in plan.splitlines():
+                self.stdout.write(f"    {line}")
+            if verdict != "ok":
+                failed.append(f"{name} ({verdict})")
+        if failed:
+            raise CommandError("запросы не по своим индексам: " + "; ".join(failed))
+        self.stdout.write(self.style.SUCCESS("все горячие запросы идут по своим индексам"))
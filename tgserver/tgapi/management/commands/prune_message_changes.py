@@ -0,0 +1,28 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tgapi.models import MessageChange
+
+
+RETENTION_DAYS = 7  # сколько дней хранится журнал изменений сообщений
+
+
+class Command(BaseCommand):
+    help = ("Удаляет из журнала MessageChange записи старше --days дней (по умолчанию "
+            f"{RETENTION_DAYS}). Клиент с курсором старше оставшегося журнала получает от "
+            "/api/messages/changes/ ответ 410 (а поток /api/events/ — событие stream.reset) "
+            "и перезагружает сообщения целиком. Запускать по расписанию, например раз в сутки из cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(days=options["days"])
+        newest = MessageChange.objects.order_by("-id").values_list("id", flat=True).first()
+        if newest is None:
+            return
+        # самую свежую запись оставляем: по ней видно, докуда журнал обрезан (MessageChange.expired)
+        deleted, _ = MessageChange.objects.filter(created_at__lt=cutoff, id__lt=newest).delete()
+        self.stdout.write(f"удалено записей журнала: {deleted}")
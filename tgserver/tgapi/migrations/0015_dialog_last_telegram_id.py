@@ -0,0 +1,59 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:02
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def fill_last_telegram_id(apps, schema_editor):
+    Dialog = apps.get_model('tgapi', 'Dialog')
+    Message = apps.get_model('tgapi', 'Message')
+    marks = (
+        Message.objects.filter(telegram_id__isnull=False)
+        .values('dialog')
+        .annotate(last=Max('telegram_id'))
+    )
+    for row in marks:
+        Dialog.objects.filter(id=row['dialog']).update(last_telegram_id=row['last'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0014_alter_message_telegram_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Media',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='media/')),
+                ('media_type', models.CharField(choices=[('photo', 'Фото'), ('video', 'Видео'), ('voice', 'Голос'), ('document', 'Документ')], max_length=20)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='dialog',
+            options={'verbose_name': 'Диалог', 'verbose_name_plural': 'Диалоги'},
+        ),
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['date'], 'verbose_name': 'Сообщение', 'verbose_name_plural': 'Сообщения'},
+        ),
+        migrations.AddField(
+            model_name='dialog',
+            name='last_telegram_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='is_read',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='media',
+            field=models.ManyToManyField(blank=True, related_name='messages', to='tgapi.media'),
+        ),
+        migrations.RunPython(fill_last_telegram_id, migrations.RunPython.noop),
+    ]
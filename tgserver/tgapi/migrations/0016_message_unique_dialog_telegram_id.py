@@ -0,0 +1,32 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:06
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def drop_duplicate_telegram_ids(apps, schema_editor):
+    """Перед уникальным ключом оставляем по одной (самой ранней) записи на (dialog, telegram_id)."""
+    Message = apps.get_model('tgapi', 'Message')
+    duplicates = (
+        Message.objects.filter(telegram_id__isnull=False)
+        .values('dialog', 'telegram_id')
+        .annotate(first=Min('id'), total=Count('id'))
+        .filter(total__gt=1)
+    )
+    for row in duplicates:
+        Message.objects.filter(dialog=row['dialog'], telegram_id=row['telegram_id']).exclude(id=row['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0015_dialog_last_telegram_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_telegram_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('dialog', 'telegram_id'), name='unique_dialog_telegram_id'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0016_message_unique_dialog_telegram_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='file_unique_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
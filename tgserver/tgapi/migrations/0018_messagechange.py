@@ -0,0 +1,28 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0017_media_file_unique_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dialog_id', models.BigIntegerField()),
+                ('message_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('created', 'Создано'), ('updated', 'Изменено'), ('deleted', 'Удалено')], max_length=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Изменение сообщения',
+                'verbose_name_plural': 'Изменения сообщений',
+                'indexes': [models.Index(fields=['dialog_id', 'id'], name='messagechange_dialog_id')],
+            },
+        ),
+    ]
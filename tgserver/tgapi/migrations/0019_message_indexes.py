@@ -0,0 +1,29 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0018_messagechange'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='message',
+            unique_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['dialog', 'date', 'id'], name='message_dialog_date'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['dialog', 'is_read'], name='message_dialog_is_read'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('delivered', False)), fields=['date', 'id'], name='message_undelivered'),
+        ),
+    ]
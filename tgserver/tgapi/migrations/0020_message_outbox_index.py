@@ -0,0 +1,21 @@
+# Generated by Django 4.2.6 on 2026-10-18 12:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tgapi', '0019_message_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_undelivered',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('delivered', False)), fields=['dialog', 'date', 'id'], name='message_outbox'),
+        ),
+    ]
@@ -1,9 +1,15 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .events import broker
 
 class Dialog(models.Model):
     account_phone = models.CharField(max_length=50)
     chat_id = models.BigIntegerField()
     chat_title = models.CharField(max_length=255)
+    # telegram_id последнего сообщения, забранного монитором (high-water mark)
+    last_telegram_id = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         verbose_name = 'Диалог'
@@ -29,7 +35,19 @@ class Message(models.Model):
     class Meta:
         verbose_name = 'Сообщение'
         verbose_name_plural = 'Сообщения'
-        unique_together = ("dialog", "text", "date")
+        constraints = [
+            # одно сообщение Telegram — одна запись в диалоге (NULL у исходящих не мешает);
+            # заодно индекс для поиска по telegram_id в диалоге
+            models.UniqueConstraint(fields=["dialog", "telegram_id"], name="unique_dialog_telegram_id"),
+        ]
+        indexes = [
+            # сообщения диалога страницами по (date, id) и последнее сообщение в списке диалогов
+            models.Index(fields=["dialog", "date", "id"], name="message_dialog_date"),
+            # непрочитанные диалога: счётчик в списке и отметка прочитанными
+            models.Index(fields=["dialog", "is_read"], name="message_dialog_is_read"),
+            # очередь отправки аккаунта (OutboxView): только недоставленные, по диалогам в порядке отправки
+            models.Index(fields=["dialog", "date", "id"], name="message_outbox", condition=models.Q(delivered=False)),
+        ]
         ordering = ["date"]  # сортировка по дате
 
     def __str__(self):
@@ -46,4 +64,88 @@ class Media(models.Model):
             ("document", "Документ"),
         ],
     )
-    uploaded_at = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    # file_unique_id из Telegram: один и тот же файл хранится один раз
+    file_unique_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    uploaded_at = models.DateTimeField(auto_now_add=True)
+
+
+class MessageChange(models.Model):
+    """
+    Журнал изменений сообщений для дельта-синхронизации клиентов: id — монотонный курсор.
+    dialog_id и message_id — просто числа, а не внешние ключи: запись об удалении переживает само сообщение.
+    """
+    CREATED = "created"
+    UPDATED = "updated"
+    DELETED = "deleted"
+
+    dialog_id = models.BigIntegerField()
+    message_id = models.BigIntegerField()
+    action = models.CharField(
+        max_length=10,
+        choices=[
+            (CREATED, "Создано"),
+            (UPDATED, "Изменено"),
+            (DELETED, "Удалено"),
+        ],
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Изменение сообщения"
+        verbose_name_plural = "Изменения сообщений"
+        indexes = [models.Index(fields=["dialog_id", "id"], name="messagechange_dialog_id")]
+
+    @classmethod
+    def expired(cls, cursor):
+        """
+        Обрезан ли журнал после курсора (см. prune_message_changes): тогда часть изменений потеряна
+        и клиенту нужна полная перезагрузка. Самая свежая запись не удаляется, так что граница видна всегда.
+        """
+        oldest = cls.objects.order_by("id").values_list("id", flat=True).first()
+        return oldest is not None and cursor < oldest - 1
+
+    @classmethod
+    def record(cls, action, messages):
+        """Записывает изменение пачки сообщений (для bulk_create и update(), которые не шлют сигналы)."""
+        cls.log([cls(dialog_id=m.dialog_id, message_id=m.id, action=action) for m in messages])
+
+    @classmethod
+    def log(cls, changes):
+        """Сохраняет записи журнала и после коммита рассылает их подписчикам потока событий."""
+        changes = cls.objects.bulk_create(changes)
+        def publish():
+            if broker.has_subscribers():
+                broker.publish(cls.events(changes))
+
+        if changes:
+            transaction.on_commit(publish)
+
+    @staticmethod
+    def events(changes):
+        """
+        События для клиентов: {"id" (курсор журнала), "type": "message.<action>", "dialog", "message",
+        "account_phone", а у живых сообщений ещё "delivered" и "is_read"} — двумя запросами на пачку.
+        """
+        states = {row["id"]: row for row in Message.objects.filter(id__in={c.message_id for c in changes})
+                  .values("id", "delivered", "is_read")}
+        phones = dict(Dialog.objects.filter(id__in={c.dialog_id for c in changes}).values_list("id", "account_phone"))
+        events = []
+        for c in changes:
+            event = {"id": c.id, "type": f"message.{c.action}", "dialog": c.dialog_id, "message": c.message_id,
+                     "account_phone": phones.get(c.dialog_id)}
+            state = states.get(c.message_id)
+            if state is not None and c.action != MessageChange.DELETED:
+                event["delivered"] = state["delivered"]
+                event["is_read"] = state["is_read"]
+            events.append(event)
+        return events
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, **kwargs):
+    MessageChange.record(MessageChange.CREATED if created else MessageChange.UPDATED, [instance])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    MessageChange.record(MessageChange.DELETED, [instance])
@@ -0,0 +1,119 @@
+import base64
+import json
+from urllib.parse import urlencode
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset-пагинация по паре (ключ, id): ?limit=, ?after=<курсор>, ?before=<курсор>.
+    Страница выбирается условием по индексу, а не OFFSET, поэтому стоит одинаково на любой глубине.
+
+    Тело ответа — прежний список, курсоры соседних страниц — в заголовке Link (rel="next" / rel="prev").
+    next есть у любой непустой страницы, так что по нему можно опрашивать появление новых записей:
+    пустая страница — пока ничего нового.
+    Без курсоров отдаётся начало списка, а при from_end = True — его конец (самые новые сообщения чата).
+    default_limit = None — без ?limit= и курсоров список отдаётся целиком, как до пагинации
+    (с курсором без limit — страницы по max_limit).
+    """
+    key = "date"  # поле или аннотация, по которой идёт порядок (второе поле — id)
+    descending = False
+    from_end = False
+    default_limit = 100
+    max_limit = 500
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        after = self.decode(request.query_params.get("after"), "after")
+        before = self.decode(request.query_params.get("before"), "before")
+        limit = request.query_params.get("limit")
+        if limit:
+            try:
+                self.limit = min(max(int(limit), 1), self.max_limit)
+            except ValueError:
+                raise ValidationError({"limit": "must be an integer"})
+        elif self.default_limit is None and after is None and before is None:
+            self.limit = None
+        else:
+            self.limit = self.default_limit or self.max_limit
+
+        sign = "-" if self.descending else ""
+        queryset = queryset.order_by(sign + self.key, sign + "id")
+        if after is not None:
+            queryset = queryset.filter(self.beyond(after, forward=True))
+        if before is not None:
+            queryset = queryset.filter(self.beyond(before, forward=False))
+
+        if before is not None or (after is None and self.from_end):
+            # страница, прилегающая к концу выборки: читаем в обратном порядке и разворачиваем
+            page = list(queryset.reverse()[:self.limit])[::-1]
+        else:
+            page = list(queryset[:self.limit])
+        self.page = page
+        return page
+
+    def beyond(self, cursor, forward):
+        """Условие «после курсора» (forward) или «до курсора» в порядке пагинации."""
+        value, pk = cursor
+        greater = forward != self.descending
+        op = "gt" if greater else "lt"
+        return Q(**{f"{self.key}__{op}": value}) | Q(**{self.key: value, f"id__{op}": pk})
+
+    def encode(self, obj):
+        value = getattr(obj, self.key)
+        raw = json.dumps([value.isoformat(), obj.pk])
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    def decode(self, cursor, param):
+        if not cursor:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+            value, pk = json.loads(raw)
+            value = parse_datetime(value)
+            if value is None:
+                raise ValueError(raw)
+            return value, int(pk)
+        except Exception:
+            raise ValidationError({param: "invalid cursor"})
+
+    def link(self, **cursor):
+        params = {k: v for k, v in self.request.query_params.items() if k not in ("after", "before", "limit")}
+        if self.limit is not None:
+            params["limit"] = self.limit
+        params.update(cursor)
+        return self.request.build_absolute_uri(self.request.path + "?" + urlencode(params))
+
+    def get_paginated_response(self, data):
+        headers = {}
+        if self.page:
+            headers["Link"] = ", ".join([
+                f'<{self.link(after=self.encode(self.page[-1]))}>; rel="next"',
+                f'<{self.link(before=self.encode(self.page[0]))}>; rel="prev"',
+            ])
+        return Response(data, headers=headers)
+
+
+class MessagePagination(KeysetPagination):
+    """
+    Сообщения по (date, id); с ?limit= — последние limit сообщений, старшие — по ссылке rel="prev".
+    Без ?limit= и курсора — весь список: веб-клиент читает историю целиком и заголовок Link не смотрит.
+    """
+    key = "date"
+    from_end = True
+    default_limit = None
+
+
+class DialogPagination(KeysetPagination):
+    """
+    Диалоги от самых свежих по последнему сообщению (аннотация activity у DialogListCreateView).
+    Без ?limit= — весь список: его целиком ждут GUI и веб-клиент.
+    """
+    key = "activity"
+    descending = True
+    default_limit = None
@@ -27,10 +27,14 @@ class MessageSerializer(serializers.ModelSerializer):
         model = Message
         fields = '__all__'
 
+class OutboxMessageSerializer(MessageSerializer):
+    chat_id = serializers.IntegerField(source="dialog.chat_id", read_only=True)
+
 class DialogSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
     last_message = serializers.SerializerMethodField()
     unread_count = serializers.SerializerMethodField()
+    last_activity = serializers.DateTimeField(read_only=True)
 
     class Meta:
         model = Dialog
@@ -38,12 +42,19 @@ class DialogSerializer(serializers.ModelSerializer):
         extra_fields = ["last_message"]
 
     def get_last_message(self, obj):
-        last_msg = Message.objects.filter(dialog=obj).order_by("-date").first()
+        # DialogListCreateView заранее достаёт последние сообщения всех диалогов одним запросом
+        last_messages = self.context.get("last_messages")
+        if last_messages is not None and hasattr(obj, "last_message_id"):
+            last_msg = last_messages.get(obj.last_message_id)
+        else:
+            last_msg = Message.objects.filter(dialog=obj).order_by("-date", "-id").first()
         if last_msg:
             return MessageSerializer(last_msg).data
         return None
 
     def get_unread_count(self, obj):
+        if hasattr(obj, "unread_count"):
+            return obj.unread_count
         return Message.objects.filter(dialog=obj,is_read=False).count()
 class DialogCreateSerializer(serializers.ModelSerializer):
     class Meta:
@@ -1,3 +1,275 @@
+import datetime
+import io
+
+from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import Dialog, Media, Message, MessageChange
+
+
+class BulkIngestTests(TestCase):
+    """POST /api/messages/bulk/: запись пачкой, повторы по (dialog, telegram_id) пропускаются."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.dialog = Dialog.objects.create(account_phone="+100", chat_id=1, chat_title="chat")
+
+    def item(self, n, **fields):
+        return {"dialog": self.dialog.id, "telegram_id": n, "sender_name": "a",
+                "text": f"m{n}", "date": "2024-01-01T00:00:00+00:00", **fields}
+
+    def post(self, items):
+        return self.client.post("/api/messages/bulk/", {"messages": items}, format="json")
+
+    def test_creates_messages(self):
+        r = self.post([self.item(1), self.item(2)])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(sorted(c["telegram_id"] for c in r.data["created"]), [1, 2])
+        self.assertEqual(r.data["skipped"], 0)
+        self.assertEqual(Message.objects.filter(dialog=self.dialog).count(), 2)
+        self.assertEqual(MessageChange.objects.filter(action=MessageChange.CREATED).count(), 2)
+
+    def test_repeated_batch_is_skipped(self):
+        self.post([self.item(1), self.item(2)])
+        r = self.post([self.item(1, text="changed"), self.item(2), self.item(3)])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([c["telegram_id"] for c in r.data["created"]], [3])
+        self.assertEqual(r.data["skipped"], 2)
+        self.assertEqual(Message.objects.filter(dialog=self.dialog).count(), 3)
+        self.assertEqual(Message.objects.get(dialog=self.dialog, telegram_id=1).text, "m1")
+
+    def test_duplicates_inside_batch(self):
+        r = self.post([self.item(5), self.item(5)])
+        self.assertEqual(len(r.data["created"]), 1)
+        self.assertEqual(r.data["skipped"], 1)
+
+    def test_bad_ids_are_rejected(self):
+        for bad in ({"telegram_id": "x"}, {"dialog": "abc"}, {"dialog": None}, {"date": "вчера"}):
+            r = self.post([self.item(1), self.item(2, **bad)])
+            self.assertEqual(r.status_code, 400, bad)
+            self.assertEqual(r.data["index"], 1)
+        self.assertFalse(Message.objects.exists())
+
+    def test_malformed_body_is_rejected(self):
+        for body in ([self.item(1)], {"messages": {"a": 1}}, {"messages": "not json"}, {"messages": [1]}):
+            r = self.client.post("/api/messages/bulk/", body, format="json")
+            self.assertEqual(r.status_code, 400, body)
+        self.assertFalse(Message.objects.exists())
+
+    def test_missing_dialog_is_rejected(self):
+        r = self.post([self.item(1), self.item(2, dialog=self.dialog.id + 100)])
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.data["index"], 1)
+        self.assertEqual(r.data["missing_dialogs"], [self.dialog.id + 100])
+        self.assertFalse(Message.objects.exists())
+
+
+class SyncStateTests(TestCase):
+    """PATCH /api/dialogs/<id>/sync/: отметка синхронизации двигается только вперёд."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.dialog = Dialog.objects.create(account_phone="+100", chat_id=1, chat_title="chat")
+
+    def patch(self, value):
+        return self.client.patch(f"/api/dialogs/{self.dialog.id}/sync/", {"last_telegram_id": value}, format="json")
+
+    def test_only_forward(self):
+        self.assertEqual(self.patch(10).data["last_telegram_id"], 10)
+        self.assertEqual(self.patch(5).data["last_telegram_id"], 10)
+
+    def test_bad_value_is_rejected(self):
+        for bad in ("abc", [1], {"a": 1}):
+            self.assertEqual(self.patch(bad).status_code, 400, bad)
+
+
+class OutboxTests(TestCase):
+    """GET /api/outbox/?account_phone=: недоставленные сообщения аккаунта в порядке отправки, с chat_id."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.mine = Dialog.objects.create(account_phone="+100", chat_id=11, chat_title="mine")
+        self.other = Dialog.objects.create(account_phone="+200", chat_id=22, chat_title="other")
+
+    def message(self, dialog, date, delivered=False):
+        return Message.objects.create(dialog=dialog, sender_name="Я", text=date, date=date, delivered=delivered)
+
+    def test_lists_undelivered_of_account(self):
+        second = self.message(self.mine, "2024-01-02T00:00:00Z")
+        first = self.message(self.mine, "2024-01-01T00:00:00Z")
+        self.message(self.mine, "2024-01-03T00:00:00Z", delivered=True)
+        self.message(self.other, "2024-01-01T00:00:00Z")
+        r = self.client.get("/api/outbox/", {"account_phone": "+100"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([m["id"] for m in r.data], [first.id, second.id])
+        self.assertEqual({m["chat_id"] for m in r.data}, {11})
+
+
+class PaginationTests(TestCase):
+    """Keyset-пагинация /api/messages/ и /api/dialogs/: ?limit=, курсоры в заголовке Link."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.dialog = Dialog.objects.create(account_phone="+100", chat_id=1, chat_title="chat")
+        base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        Message.objects.bulk_create([
+            Message(dialog=self.dialog, sender_name="a", text=str(i), date=base + datetime.timedelta(minutes=i // 2))
+            for i in range(150)
+        ])
+
+    def get(self, url, params=None):
+        r = self.client.get(url, params)
+        self.assertEqual(r.status_code, 200, r.content)
+        return r
+
+    def follow(self, r, rel):
+        url = r.headers["Link"].split(f'>; rel="{rel}"')[0].rsplit("<", 1)[1]
+        return self.get(url)
+
+    def test_messages_latest_page_and_back(self):
+        r = self.get("/api/messages/", {"dialog": self.dialog.id, "limit": 60})
+        self.assertEqual([m["text"] for m in r.data], [str(i) for i in range(90, 150)])
+        seen = [m["text"] for m in r.data]
+        while r.data:
+            r = self.follow(r, "prev")
+            seen = [m["text"] for m in r.data] + seen
+        self.assertEqual(seen, [str(i) for i in range(150)])
+
+    def test_messages_next_page_is_empty_until_new_message(self):
+        r = self.get("/api/messages/", {"dialog": self.dialog.id, "limit": 10})
+        self.assertEqual(self.follow(r, "next").data, [])
+        Message.objects.create(dialog=self.dialog, sender_name="a", text="new",
+                               date=datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertEqual([m["text"] for m in self.follow(r, "next").data], ["new"])
+
+    def test_messages_whole_list_without_limit(self):
+        r = self.get("/api/messages/", {"dialog": self.dialog.id})
+        self.assertEqual([m["text"] for m in r.data], [str(i) for i in range(150)])
+
+    def test_dialogs_whole_list_without_limit(self):
+        Dialog.objects.bulk_create([Dialog(account_phone="+100", chat_id=100 + i, chat_title=str(i)) for i in range(120)])
+        r = self.get("/api/dialogs/")
+        self.assertEqual(len(r.data), 121)
+        self.assertEqual(r.data[0]["id"], self.dialog.id)  # единственный диалог с сообщениями — первый
+
+    def test_dialogs_pages(self):
+        Dialog.objects.bulk_create([Dialog(account_phone="+100", chat_id=100 + i, chat_title=str(i)) for i in range(120)])
+        r = self.get("/api/dialogs/", {"limit": 50})
+        ids = [d["id"] for d in r.data]
+        while r.data:
+            r = self.follow(r, "next")
+            ids += [d["id"] for d in r.data]
+        self.assertEqual(sorted(ids), sorted(Dialog.objects.values_list("id", flat=True)))
+
+    def test_bad_limit_and_cursor(self):
+        for params in ({"limit": "many"}, {"before": "garbage"}):
+            for url in ("/api/messages/", "/api/dialogs/"):
+                r = self.client.get(url, {"dialog": self.dialog.id, **params} if "messages" in url else params)
+                self.assertEqual(r.status_code, 400, (url, params))
+
+
+class DialogListTests(TestCase):
+    """GET /api/dialogs/: последнее сообщение и число непрочитанных за постоянное число запросов."""
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def add_dialogs(self, n):
+        base = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        for i in range(n):
+            dialog = Dialog.objects.create(account_phone="+100", chat_id=Dialog.objects.count() + 1, chat_title=str(i))
+            for j in range(2):
+                message = Message.objects.create(dialog=dialog, sender_name="a", text=str(j),
+                                                 date=base + datetime.timedelta(minutes=j))
+            message.media.add(Media.objects.create(file=f"media/{dialog.id}.jpg", media_type="photo"))
+
+    def test_queries_do_not_grow_with_dialogs(self):
+        for total in (3, 30):
+            self.add_dialogs(total - Dialog.objects.count())
+            with self.assertNumQueries(3):
+                r = self.client.get("/api/dialogs/")
+            self.assertEqual(len(r.data), total)
+            self.assertTrue(all(d["last_message"]["text"] == "1" and d["last_message"]["media"] for d in r.data))
+            self.assertTrue(all(d["unread_count"] == 2 for d in r.data))
+
+
+class MessageChangesTests(TestCase):
+    """GET /api/messages/changes/?since=: дельта по журналу MessageChange и его обрезка."""
+
+    def setUp(self):
+        self.client = APIClient()
+        self.dialog = Dialog.objects.create(account_phone="+100", chat_id=1, chat_title="chat")
+
+    def message(self, text):
+        return Message.objects.create(dialog=self.dialog, sender_name="a", text=text,
+                                      date=datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+
+    def changes(self, since=None):
+        params = {"dialog": self.dialog.id}
+        if since is not None:
+            params["since"] = since
+        return self.client.get("/api/messages/changes/", params)
+
+    def test_delta_after_cursor(self):
+        edited, removed = self.message("old"), self.message("gone")
+        cursor = self.changes().data["cursor"]
+        created = self.message("new")
+        edited.text = "edited"
+        edited.save()
+        removed_id = removed.id
+        removed.delete()
+        r = self.changes(cursor)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([m["id"] for m in r.data["created"]], [created.id])
+        self.assertEqual([m["text"] for m in r.data["updated"]], ["edited"])
+        self.assertEqual(r.data["deleted"], [removed_id])
+        self.assertEqual(self.changes(r.data["cursor"]).data["created"], [])
+
+    def test_media_upload_is_logged_once(self):
+        cursor = self.changes().data["cursor"]
+        r = self.client.post("/api/messages_media/", {"dialog": self.dialog.id, "sender_name": "Я", "text": "hi",
+                                                      "date": "2024-01-01T00:00:00"})
+        self.assertEqual(r.status_code, 201)
+        self.assertEqual(list(MessageChange.objects.filter(id__gt=cursor).values_list("action", flat=True)),
+                         [MessageChange.CREATED])
+
+    def test_pruned_cursor_is_gone(self):
+        for i in range(3):
+            self.message(str(i))
+        MessageChange.objects.update(created_at=timezone.now() - datetime.timedelta(days=30))
+        call_command("prune_message_changes", stdout=io.StringIO())
+        self.assertEqual(MessageChange.objects.count(), 1)  # самая свежая запись остаётся
+        r = self.changes(0)
+        self.assertEqual(r.status_code, 410)
+        self.assertEqual(r.data["cursor"], MessageChange.objects.get().id)
+        self.assertEqual(self.changes(r.data["cursor"]).status_code, 200)
+
+    def test_bad_params(self):
+        for params in ({"dialog": "x"}, {"since": "abc"}, {"since": 0, "limit": "many"}):
+            r = self.client.get("/api/messages/changes/", params)
+            self.assertEqual(r.status_code, 400, params)
+
+    def test_limit_is_at_least_one(self):
+        cursor = self.changes().data["cursor"]
+        first = self.message("1")
+        self.message("2")
+        r = self.client.get("/api/messages/changes/", {"dialog": self.dialog.id, "since": cursor, "limit": -5})
+        self.assertEqual([m["id"] for m in r.data["created"]], [first.id])
+        self.assertTrue(r.data["has_more"])
+
+    def test_event_stream_needs_asgi(self):
+        # тестовый клиент ходит через WSGI: бесконечный поток там не отдаём
+        r = self.client.get("/api/events/")
+        self.assertEqual(r.status_code, 501)
+
+
+class QueryPlanTests(TestCase):
+    """manage.py check_query_plans: горячие запросы идут по своим индексам."""
 
-# Create your tests here.
+    def test_hot_queries_use_indexes(self):
+        Dialog.objects.create(account_phone="+100", chat_id=1, chat_title="chat")
+        out = io.StringIO()
+        call_command("check_query_plans", stdout=out)
+        self.assertNotIn("FULL SCAN", out.getvalue())
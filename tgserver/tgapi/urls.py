@@ -1,10 +1,16 @@
 from django.urls import path
-from .views import DialogListCreateView, MessageListCreateView, MessageUpdateDeliveredView,MessageMediaListCreateView
+from .views import DialogListCreateView, MessageListCreateView, MessageUpdateDeliveredView,MessageMediaListCreateView,\
+    DialogSyncStateView, OutboxView, MessageBulkIngestView, MessageChangesView, message_events
 
 urlpatterns = [
     path('api/dialogs/', DialogListCreateView.as_view()),
     path('api/dialogs/<int:pk>/', DialogListCreateView.as_view()),
+    path('api/dialogs/<int:pk>/sync/', DialogSyncStateView.as_view()),
     path('api/messages/', MessageListCreateView.as_view()),
     path('api/messages_media/', MessageMediaListCreateView.as_view()),
+    path('api/messages/bulk/', MessageBulkIngestView.as_view()),
+    path('api/messages/changes/', MessageChangesView.as_view()),
+    path('api/outbox/', OutboxView.as_view()),
+    path('api/events/', message_events),
     path('api/messages/<int:pk>/', MessageUpdateDeliveredView.as_view()),
 ]
@@ -1,26 +1,118 @@
 from rest_framework import generics
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from .models import Dialog, Message, Media
-from .serializers import DialogSerializer, MessageSerializer
+from .models import Dialog, Message, Media, MessageChange
+from .serializers import DialogSerializer, MessageSerializer, DialogCreateSerializer, OutboxMessageSerializer
+from .pagination import DialogPagination, MessagePagination
+from .events import broker
 from rest_framework import status, viewsets
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.filters import OrderingFilter
+from django.db import transaction
+from django.db.models import Count, DateTimeField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.core.files.storage import default_storage
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from asgiref.sync import sync_to_async
+from django.utils.dateparse import parse_datetime
+import asyncio
+import datetime
+import json
+import os
+
+def media_from_store(item):
+    """
+    Media для файла, который монитор уже положил в MEDIA_ROOT (item: file, media_type, file_unique_id).
+    Один file_unique_id — одна запись Media.
+    """
+    name = os.path.normpath(str(item.get("file", ""))).replace("\\", "/")
+    upload_to = Media._meta.get_field("file").upload_to.rstrip("/")
+    if not name.startswith(upload_to + "/") or not default_storage.exists(name):
+        raise ValueError(f"file {item.get('file')!r} is not in media storage")
+    media_type = item.get("media_type") or media_type_for(name)
+    if item.get("file_unique_id"):
+        media, _ = Media.objects.get_or_create(
+            file_unique_id=item["file_unique_id"], defaults={"file": name, "media_type": media_type}
+        )
+        return media
+    return Media.objects.create(file=name, media_type=media_type)
+
+
+def media_type_for(file_name):
+    """Тип медиа по расширению файла."""
+    ext = file_name.split(".")[-1].lower()
+    if ext in ["jpg", "jpeg", "png"]:
+        return "photo"
+    elif ext in ["mp4"]:
+        return "video"
+    elif ext in ["ogg"]:
+        return "voice"
+    return "document"
+
 
 class DialogListCreateView(generics.ListCreateAPIView):
+    """
+    Список диалогов с последним сообщением и числом непрочитанных за постоянное число запросов:
+    последнее сообщение — подзапросом, непрочитанные — одним агрегатом.
+    Диалоги идут от самых свежих по последнему сообщению; с ?limit= — страницами (см. DialogPagination).
+    """
     queryset = Dialog.objects.all()
     serializer_class = DialogSerializer
-    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filter_backends = [DjangoFilterBackend]
     filterset_fields = ['account_phone', 'chat_id']
-    ordering_fields = ['chat_id']
+    pagination_class = DialogPagination
+
+    def get_queryset(self):
+        last = Message.objects.filter(dialog=OuterRef("pk")).order_by("-date", "-id")
+        last_activity = Subquery(last.values("date")[:1])
+        return Dialog.objects.annotate(
+            last_message_id=Subquery(last.values("id")[:1]),
+            last_activity=last_activity,
+            # ключ пагинации: у диалогов без сообщений — начало эпохи, чтобы сравнение не упиралось в NULL
+            activity=Coalesce(last_activity, Value(datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)),
+                              output_field=DateTimeField()),
+            unread_count=Count("message", filter=Q(message__is_read=False)),
+        )
+
+    def list(self, request, *args, **kwargs):
+        dialogs = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        context = self.get_serializer_context()
+        context["last_messages"] = Message.objects.prefetch_related("media").in_bulk(
+            [dialog.last_message_id for dialog in dialogs if dialog.last_message_id]
+        )
+        serializer = DialogSerializer(dialogs, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
 
+class DialogSyncStateView(generics.UpdateAPIView):
+    """Отметка последнего забранного монитором telegram_id (двигается только вперёд)."""
+    queryset = Dialog.objects.all()
+    serializer_class = DialogCreateSerializer
+
+    def patch(self, request, *args, **kwargs):
+        dialog = self.get_object()
+        last_telegram_id = request.data.get("last_telegram_id")
+        if last_telegram_id is not None:
+            try:
+                last_telegram_id = int(last_telegram_id)
+            except (TypeError, ValueError):
+                raise ValidationError({"last_telegram_id": "must be an integer"})
+            Dialog.objects.filter(id=dialog.id).filter(
+                Q(last_telegram_id__isnull=True) | Q(last_telegram_id__lt=last_telegram_id)
+            ).update(last_telegram_id=last_telegram_id)
+            dialog.refresh_from_db()
+        serializer = DialogCreateSerializer(dialog)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
 class MessageListCreateView(generics.ListCreateAPIView):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     filter_backends = [DjangoFilterBackend, OrderingFilter]
     filterset_fields = ['dialog', 'delivered', 'telegram_id']
     ordering_fields = ['date']
+    pagination_class = MessagePagination
     def get(self,request,*args,**kwargs):
         dialog_id = request.GET.get('dialog', None)
         messages = Message.objects.all()
@@ -42,9 +134,181 @@ class MessageListCreateView(generics.ListCreateAPIView):
             telegram_id = int(telegram_id.replace("'", '').replace('/', ''))
             messages = messages.filter(telegram_id=telegram_id)
         if dialog_id is not None and telegram_id is None and from_gui is not None:
-            Message.objects.filter(dialog=Dialog.objects.get(id=dialog_id), is_read=False).update(is_read=True)
-        serializer = MessageSerializer(messages,many=True)
+            with transaction.atomic():
+                unread = list(Message.objects.filter(dialog=Dialog.objects.get(id=dialog_id), is_read=False)
+                              .only("id", "dialog_id"))
+                if unread:
+                    Message.objects.filter(id__in=[m.id for m in unread]).update(is_read=True)
+                    MessageChange.record(MessageChange.UPDATED, unread)
+        # страница по (date, id): ?limit=, ?before=, ?after= (см. MessagePagination)
+        page = self.paginate_queryset(messages.prefetch_related("media"))
+        serializer = MessageSerializer(page,many=True)
+        return self.get_paginated_response(serializer.data)
+class OutboxView(generics.ListAPIView):
+    """Недоставленные сообщения аккаунта вместе с chat_id и медиа — очередь отправки для монитора."""
+    queryset = Message.objects.filter(delivered=False)
+    serializer_class = OutboxMessageSerializer
+
+    def get(self, request, *args, **kwargs):
+        messages = Message.objects.filter(delivered=False).select_related("dialog").prefetch_related("media")
+        account_phone = request.GET.get('account_phone', None)
+        if account_phone is not None:
+            messages = messages.filter(dialog__account_phone=account_phone)
+        serializer = OutboxMessageSerializer(messages.order_by("date", "id"), many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
+
+class MessageChangesView(generics.GenericAPIView):
+    """
+    Дельта-синхронизация: что изменилось в сообщениях после курсора ?since=.
+    Фильтры: ?dialog=, ?account_phone=; ?limit= — сколько записей журнала разобрать за раз.
+    Ответ: {"cursor", "created": [...], "updated": [...], "deleted": [id, ...], "has_more"}.
+    Без since возвращается только текущий курсор — его берут перед первой загрузкой сообщений.
+    Если журнал уже обрезан после since (prune_message_changes), ответ — 410 с текущим курсором:
+    клиент перезагружает сообщения целиком и продолжает с этого курсора.
+    """
+    queryset = MessageChange.objects.all()
+    serializer_class = MessageSerializer
+    default_limit = 500
+    max_limit = 2000
+
+    @staticmethod
+    def int_param(request, name, default=None):
+        value = request.GET.get(name, None)
+        if value is None:
+            return default
+        try:
+            return int(value)
+        except ValueError:
+            raise ValidationError({name: "must be an integer"})
+
+    def get(self, request, *args, **kwargs):
+        changes = MessageChange.objects.all()
+        dialog_id = self.int_param(request, 'dialog')
+        if dialog_id is not None:
+            changes = changes.filter(dialog_id=dialog_id)
+        account_phone = request.GET.get('account_phone', None)
+        if account_phone is not None:
+            changes = changes.filter(dialog_id__in=Dialog.objects.filter(account_phone=account_phone).values("id"))
+
+        since = self.int_param(request, 'since')
+        limit = min(max(self.int_param(request, 'limit', self.default_limit), 1), self.max_limit)
+        if since is None:
+            last = changes.order_by("-id").values_list("id", flat=True).first()
+            return Response({"cursor": last or 0, "created": [], "updated": [], "deleted": [], "has_more": False})
+
+        if MessageChange.expired(since):
+            return Response({"detail": "cursor too old, reload messages", "cursor": head_cursor()},
+                            status=status.HTTP_410_GONE)
+        batch = list(changes.filter(id__gt=since).order_by("id").values_list("id", "message_id", "action")[:limit + 1])
+        has_more = len(batch) > limit
+        batch = batch[:limit]
+
+        # по каждому сообщению важен итог: создано (в каком бы виде ни было сейчас), изменено или удалено
+        final = {}
+        for _, message_id, action in batch:
+            if action == MessageChange.DELETED or final.get(message_id) != MessageChange.CREATED:
+                final[message_id] = action
+        alive = Message.objects.filter(id__in=[pk for pk, action in final.items() if action != MessageChange.DELETED]) \
+            .prefetch_related("media").order_by("date", "id")
+        created, updated = [], []
+        for message in alive:
+            (created if final[message.id] == MessageChange.CREATED else updated).append(message)
+        found = {m.id for m in created + updated}
+        deleted = sorted(pk for pk in final if pk not in found)
+        return Response({
+            "cursor": batch[-1][0] if batch else since,
+            "created": MessageSerializer(created, many=True).data,
+            "updated": MessageSerializer(updated, many=True).data,
+            "deleted": deleted,
+            "has_more": has_more,
+        })
+
+EVENTS_KEEPALIVE = 15  # секунд между комментариями-пингами в потоке событий
+EVENTS_REPLAY_LIMIT = 1000  # событий журнала за один запрос при досылке пропущенного
+
+
+def head_cursor():
+    last = MessageChange.objects.order_by("-id").values_list("id", flat=True).first()
+    return last or 0
+
+
+def replay_events(since, dialog_id=None, account_phone=None):
+    """События из журнала MessageChange после since — для переподключения и отставших подписчиков."""
+    changes = MessageChange.objects.filter(id__gt=since).order_by("id")
+    if dialog_id is not None:
+        changes = changes.filter(dialog_id=dialog_id)
+    if account_phone is not None:
+        changes = changes.filter(dialog_id__in=Dialog.objects.filter(account_phone=account_phone).values("id"))
+    return MessageChange.events(list(changes[:EVENTS_REPLAY_LIMIT]))
+
+
+async def message_events(request):
+    """
+    Поток событий сообщений (Server-Sent Events): message.created / message.updated / message.deleted
+    с полями delivered и is_read. Фильтры: ?dialog=, ?account_phone=.
+    id события — курсор журнала MessageChange: после обрыва клиент переподключается с заголовком
+    Last-Event-ID (или ?since=) и получает пропущенное, подробности — через /api/messages/changes/.
+    Если пропущенное уже удалено из журнала, вместо него приходит stream.reset — перезагрузить всё.
+    Работает через ASGI (tgserver/asgi.py); брокер живёт в процессе, так что сервер — один процесс.
+    Под WSGI бесконечный поток занял бы воркер навсегда — там отвечаем 501, клиенты опрашивают API.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse({"detail": "event stream needs ASGI, poll /api/messages/changes/"}, status=501)
+
+    dialog_id = request.GET.get('dialog', None)
+    dialog_id = int(dialog_id) if dialog_id is not None else None
+    account_phone = request.GET.get('account_phone', None)
+    since = request.headers.get("Last-Event-ID") or request.GET.get('since', None)
+
+    def message(event):
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    async def stream():
+        # подписываемся при старте потока (иначе при обрыве до первой строки отписка не выполнится),
+        # но до досылки из журнала, чтобы между ними ничего не потерять
+        subscription = broker.subscribe(dialog_id, account_phone)
+        try:
+            last_id = int(since) if since else None
+            reset = last_id is not None and await sync_to_async(MessageChange.expired)(last_id)
+            if last_id is None or reset:
+                last_id, replay_from = await sync_to_async(head_cursor)(), None
+            else:
+                replay_from = last_id
+            yield "retry: 3000\n\n"
+            if reset:
+                yield message({"id": last_id, "type": "stream.reset"})
+            while True:
+                if subscription.overflow:
+                    # подписчик отстал и очередь переполнилась — добираем пропущенное из журнала
+                    subscription.overflow = False
+                    while not subscription.queue.empty():
+                        subscription.queue.get_nowait()
+                    replay_from = last_id
+                if replay_from is not None:
+                    events = await sync_to_async(replay_events)(replay_from, dialog_id, account_phone)
+                    for event in events:
+                        last_id = event["id"]
+                        yield message(event)
+                    replay_from = last_id if len(events) == EVENTS_REPLAY_LIMIT else None
+                    continue
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event["id"] <= last_id:
+                    # уже отправлено при досылке из журнала
+                    continue
+                last_id = event["id"]
+                yield message(event)
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 class MessageMediaListCreateView(generics.ListCreateAPIView):
     queryset = Message.objects.all().order_by("date")
     serializer_class = MessageSerializer
@@ -56,28 +320,127 @@ class MessageMediaListCreateView(generics.ListCreateAPIView):
         # создаём сообщение
         serializer = self.get_serializer(data=data)
         serializer.is_valid(raise_exception=True)
-        message = serializer.save()
-
-        # прикрепляем файлы, если есть
-        files = request.FILES.getlist("files")
-        print(len(files))
-        for f in files:
-            ext = f.name.split(".")[-1].lower()
-            if ext in ["jpg", "jpeg", "png"]:
-                mtype = "photo"
-            elif ext in ["mp4"]:
-                mtype = "video"
-            elif ext in ["ogg"]:
-                mtype = "voice"
-            else:
-                mtype = "document"
+        # одной транзакцией: событие message.created уходит подписчикам, когда файлы уже прикреплены
+        with transaction.atomic():
+            message = serializer.save()
 
-            media = Media.objects.create(file=f, media_type=mtype)
-            message.media.add(media)
+            # прикрепляем файлы, если есть (M2M пишется сразу, повторный save() не нужен)
+            files = request.FILES.getlist("files")
+            print(len(files))
+            for f in files:
+                media = Media.objects.create(file=f, media_type=media_type_for(f.name))
+                message.media.add(media)
 
-        message.save()
         return Response(self.get_serializer(message).data, status=status.HTTP_201_CREATED)
 
+class MessageBulkIngestView(generics.GenericAPIView):
+    """
+    Пакетная запись сообщений из Telegram одной транзакцией.
+    Ключ — (dialog, telegram_id): уже существующие сообщения молча пропускаются.
+    Принимает JSON {"messages": [...]} или multipart, где messages — JSON-строка,
+    а файлы i-го сообщения передаются в поле files_<i>. Файлы, уже лежащие в MEDIA_ROOT,
+    передаются без загрузки: в сообщении "media": [{"file", "media_type", "file_unique_id"}].
+    """
+    queryset = Message.objects.all()
+    serializer_class = MessageSerializer
+    parser_classes = [JSONParser, MultiPartParser, FormParser]
+
+    def post(self, request, *args, **kwargs):
+        items = request.data.get("messages", []) if isinstance(request.data, dict) else None
+        if isinstance(items, str):
+            try:
+                items = json.loads(items)
+            except ValueError:
+                items = None
+        if not isinstance(items, list):
+            return Response({"error": "messages must be a list"}, status=status.HTTP_400_BAD_REQUEST)
+
+        rows = []
+        for i, item in enumerate(items):
+            try:
+                date = parse_datetime(str(item.get("date", "")))
+                dialog_id, telegram_id = int(item["dialog"]), int(item["telegram_id"])
+            except (AttributeError, KeyError, TypeError, ValueError):
+                date = None
+            if date is None:
+                return Response({"error": f"message {i}: dialog, telegram_id and date are required", "index": i},
+                                status=status.HTTP_400_BAD_REQUEST)
+            rows.append((i, dialog_id, telegram_id, date, item))
+
+        # несуществующий диалог (например, удалённый, а у монитора ещё в кэше) — 400 до записи,
+        # missing_dialogs — чтобы клиент забыл эти id
+        known = set(Dialog.objects.filter(id__in={row[1] for row in rows}).values_list("id", flat=True))
+        missing = [row for row in rows if row[1] not in known]
+        if missing:
+            i, dialog_id = missing[0][0], missing[0][1]
+            return Response({"error": f"message {i}: dialog {dialog_id} does not exist", "index": i,
+                             "missing_dialogs": sorted({row[1] for row in missing})},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        created = []
+        with transaction.atomic():
+            keys = {}
+            for i, dialog_id, telegram_id, date, item in rows:
+                keys.setdefault(dialog_id, set()).add(telegram_id)
+            existing = set()
+            for dialog_id, telegram_ids in keys.items():
+                existing.update(
+                    Message.objects.filter(dialog_id=dialog_id, telegram_id__in=telegram_ids)
+                    .values_list("dialog_id", "telegram_id")
+                )
+
+            new_rows = []
+            for row in rows:
+                key = (row[1], row[2])
+                if key in existing:
+                    continue
+                existing.add(key)
+                new_rows.append(row)
+
+            Message.objects.bulk_create([
+                Message(
+                    dialog_id=dialog_id,
+                    telegram_id=telegram_id,
+                    sender_name=item.get("sender_name", ""),
+                    text=item.get("text") or "",
+                    date=date,
+                    delivered=item.get("delivered", True),
+                    account_phone=item.get("account_phone"),
+                )
+                for i, dialog_id, telegram_id, date, item in new_rows
+            ], ignore_conflicts=True)
+
+            ids = {}
+            for dialog_id, telegram_ids in keys.items():
+                for pk, telegram_id in Message.objects.filter(dialog_id=dialog_id, telegram_id__in=telegram_ids) \
+                        .values_list("id", "telegram_id"):
+                    ids[(dialog_id, telegram_id)] = pk
+
+            links = []
+            for i, dialog_id, telegram_id, date, item in new_rows:
+                pk = ids.get((dialog_id, telegram_id))
+                if pk is None:
+                    continue
+                created.append({"id": pk, "dialog": dialog_id, "telegram_id": telegram_id})
+                for f in request.FILES.getlist(f"files_{i}"):
+                    media = Media.objects.create(file=f, media_type=media_type_for(f.name))
+                    links.append(Message.media.through(message_id=pk, media_id=media.id))
+                for media_item in item.get("media") or []:
+                    try:
+                        media = media_from_store(media_item)
+                    except ValueError as e:
+                        print(f"Пропускаем медиа: {e}")
+                        continue
+                    links.append(Message.media.through(message_id=pk, media_id=media.id))
+            Message.media.through.objects.bulk_create(links)
+            # bulk_create не шлёт post_save — журнал изменений пишем сами
+            MessageChange.log([
+                MessageChange(dialog_id=c["dialog"], message_id=c["id"], action=MessageChange.CREATED) for c in created
+            ])
+
+        return Response({"created": created, "skipped": len(rows) - len(created)}, status=status.HTTP_200_OK)
+
+
 class MessageUpdateDeliveredView(generics.UpdateAPIView):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
@@ -89,6 +452,10 @@ class MessageUpdateDeliveredView(generics.UpdateAPIView):
         if delivered is not None:
             message.delivered = delivered
             message.save()
+        text = request.data.get("text")
+        if text is not None:
+            message.text = text
+            message.save()
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_200_OK)
     def delete(self, request, *args, **kwargs):